@@ -12,80 +12,121 @@
 import base64
 import hmac
 import httplib
+import md5
+import os
+import Queue
+import random
 import re
+import select
 import sha
+import socket
 import sys
+import tempfile
+import threading
 import time
 import urllib
 import urlparse
 import xml.sax
+from xml.sax.saxutils import escape as xml_escape
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 METADATA_PREFIX = 'x-amz-meta-'
 AMAZON_HEADER_PREFIX = 'x-amz-'
+# request bodies are sent in pieces of this size
+CHUNK_SIZE = 64 * 1024
+# iterators are spooled to a temporary file to learn their length, in memory up to this size
+SPOOL_MAX_SIZE = 1024 * 1024
+# multipart uploads: S3 wants parts of at least 5MB (except the last one) and at most 10000 parts
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_WORKERS = 4
+DEFAULT_PART_RETRIES = 3
+# largest object a single copy_object can copy, bigger ones are copied part by part
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+DEFAULT_COPY_PART_SIZE = 512 * 1024 * 1024
+# Multi-Object Delete takes at most this many keys per request
+MAX_DELETE_KEYS = 1000
+# redirects followed by a single request
+MAX_REDIRECTS = 5
+# query arguments which are part of the signed resource, sorted as S3 expects them
+SUBRESOURCES = ('acl', 'delete', 'location', 'logging', 'partNumber', 'torrent', 'uploadId', 'uploads', 'versionId')
 
 # generates the aws canonical string for the given parameters
 def canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
-    interesting_headers = {}
+    content_md5 = content_type = ''
+    date = None
+    amz_headers = {}
     for header_key in headers:
         lk = header_key.lower()
-        if lk in ['content-md5', 'content-type', 'date'] or lk.startswith(AMAZON_HEADER_PREFIX):
-            interesting_headers[lk] = headers[header_key].strip()
-
-    # these keys get empty strings if they don't exist
-    if not interesting_headers.has_key('content-type'):
-        interesting_headers['content-type'] = ''
-    if not interesting_headers.has_key('content-md5'):
-        interesting_headers['content-md5'] = ''
+        if lk == 'content-md5':
+            content_md5 = headers[header_key].strip()
+        elif lk == 'content-type':
+            content_type = headers[header_key].strip()
+        elif lk == 'date':
+            date = headers[header_key].strip()
+        elif lk.startswith(AMAZON_HEADER_PREFIX):
+            amz_headers[lk] = headers[header_key].strip()
 
     # just in case someone used this.  it's not necessary in this lib.
-    if interesting_headers.has_key('x-amz-date'):
-        interesting_headers['date'] = ''
+    if amz_headers.has_key('x-amz-date'):
+        date = ''
 
     # if you're using expires for query string auth, then it trumps date
     # (and x-amz-date)
     if expires:
-        interesting_headers['date'] = str(expires)
-
-    sorted_header_keys = interesting_headers.keys()
-    sorted_header_keys.sort()
+        date = str(expires)
 
-    buf = "%s\n" % method
-    for header_key in sorted_header_keys:
-        if header_key.startswith(AMAZON_HEADER_PREFIX):
-            buf += "%s:%s\n" % (header_key, interesting_headers[header_key])
-        else:
-            buf += "%s\n" % interesting_headers[header_key]
+    buf = [method, content_md5, content_type]
+    if date is not None:
+        buf.append(date)
+    if amz_headers:
+        for header_key in sorted(amz_headers):
+            buf.append("%s:%s" % (header_key, amz_headers[header_key]))
 
-    # append the bucket if it exists
+    # append the bucket if it exists, then the key.  even if it doesn't exist, add the slash
     if bucket != "":
-        buf += "/%s" % bucket
-
-    # add the key.  even if it doesn't exist, add the slash
-    buf += "/%s" % urllib.quote_plus(key)
+        resource = "/%s/%s" % (bucket, urllib.quote_plus(key))
+    else:
+        resource = "/%s" % urllib.quote_plus(key)
 
     # handle special query string arguments
-
-    if query_args.has_key("acl"):
-        buf += "?acl"
-    elif query_args.has_key("torrent"):
-        buf += "?torrent"
-    elif query_args.has_key("logging"):
-        buf += "?logging"
-    elif query_args.has_key("location"):
-        buf += "?location"
-
-    return buf
+    if query_args:
+        subresources = []
+        for name in SUBRESOURCES:
+            if query_args.has_key(name):
+                if query_args[name] is None:
+                    subresources.append(name)
+                else:
+                    subresources.append("%s=%s" % (name, query_args[name]))
+        if subresources:
+            resource += "?" + "&".join(subresources)
+    buf.append(resource)
+
+    return "\n".join(buf)
+
+class Signer:
+    """
+    Computes the base64'ed hmac-sha of strings with a secret access key.
+    The hmac is keyed once and its state copied for every signature.
+    """
+    def __init__(self, aws_secret_access_key):
+        self._hmac = hmac.new(aws_secret_access_key, digestmod=sha)
+
+    def sign(self, str, urlencode=False):
+        h = self._hmac.copy()
+        h.update(str)
+        b64_hmac = base64.b64encode(h.digest())
+        if urlencode:
+            return urllib.quote_plus(b64_hmac)
+        else:
+            return b64_hmac
 
 # computes the base64'ed hmac-sha hash of the canonical string and the secret
 # access key, optionally urlencoding the result
 def encode(aws_secret_access_key, str, urlencode=False):
-    b64_hmac = base64.encodestring(hmac.new(aws_secret_access_key, str, sha).digest()).strip()
-    if urlencode:
-        return urllib.quote_plus(b64_hmac)
-    else:
-        return b64_hmac
+    return Signer(aws_secret_access_key).sign(str, urlencode)
 
 def merge_meta(headers, metadata):
     final_headers = headers.copy()
@@ -106,6 +147,183 @@ def query_args_hash_to_string(query_args):
 
     return '&'.join(pairs)
 
+# returns the number of bytes left in data, or None if it can not be known without reading it
+def data_length(data):
+    if isinstance(data, unicode):
+        return len(data.encode('utf-8'))
+    if isinstance(data, (str, bytearray, buffer, memoryview)):
+        return len(data)
+    if not hasattr(data, 'read'):
+        return None
+    try:
+        start = data.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+    try:
+        return os.fstat(data.fileno()).st_size - start
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        data.seek(0, 2)
+        end = data.tell()
+        data.seek(start)
+        return end - start
+    except (AttributeError, IOError, OSError):
+        return None
+
+# splits data (a string, buffer, file-like object or iterator) into strings of part_size bytes
+def iter_parts(data, part_size):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if isinstance(data, (str, bytearray, buffer, memoryview)):
+        for offset in xrange(0, len(data), part_size):
+            part = data[offset:offset + part_size]
+            yield part.tobytes() if isinstance(part, memoryview) else str(part)
+        return
+    if hasattr(data, 'read'):
+        read = data.read
+        data = iter(lambda: read(CHUNK_SIZE), '')
+    pending = []
+    pending_size = 0
+    for chunk in data:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= part_size:
+            buf = ''.join(pending)
+            for offset in xrange(0, len(buf) - part_size + 1, part_size):
+                yield buf[offset:offset + part_size]
+            rest = buf[len(buf) - len(buf) % part_size:]
+            pending = rest and [rest] or []
+            pending_size = len(rest)
+    if pending_size:
+        yield ''.join(pending)
+
+# the x-amz-copy-source header value of an object, its key url encoded
+def copy_source(bucket, key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return urllib.quote('%s/%s' % (bucket, key))
+
+# headers of a server side copy. Unless metadata_directive ('COPY' or 'REPLACE') is given the
+# metadata is copied, or replaced when copying an object onto itself
+def copy_object_headers(source_bucket, source_key, destination_bucket, destination_key, headers={}, metadata_directive=None):
+    headers = headers.copy()
+    headers['x-amz-copy-source'] = copy_source(source_bucket, source_key)
+    if metadata_directive is None:
+        metadata_directive = 'REPLACE' if (source_bucket==destination_bucket and source_key==destination_key) else 'COPY'
+    headers['x-amz-metadata-directive'] = metadata_directive
+    return headers
+
+# builds a Range header value: (0, 99) is the first 100 bytes, (100, None) everything
+# from byte 100 on and (-100, None) the last 100 bytes
+def range_header(start, end=None):
+    if start < 0:
+        return 'bytes=%d' % start
+    if end is None:
+        return 'bytes=%d-' % start
+    return 'bytes=%d-%d' % (start, end)
+
+# returns the value of a header regardless of the case of its name
+def get_header(headers, name, default=None):
+    name = name.lower()
+    for k, v in headers.items():
+        if k.lower() == name:
+            return v
+    return default
+
+
+class RequestBody:
+    """
+    A request body with a known length, sent in CHUNK_SIZE pieces.
+    data may be a string, a buffer (bytearray, buffer, memoryview), a file-like
+    object or an iterator of strings. File objects are streamed from their current
+    position; when their size can not be found they are spooled like iterators.
+    length may be passed when known up front (e.g. from a Content-Length header),
+    the data is then read as a stream without spooling.
+    """
+    def __init__(self, data, length=None):
+        self._data = None
+        self._file = None
+        self._start = None
+        self._spooled = False
+
+        if data is None:
+            data = ''
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if isinstance(data, (str, bytearray, buffer, memoryview)):
+            self._data = data
+            self.length = len(data)
+            return
+
+        if hasattr(data, 'read'):
+            self._file = data
+            if length is None:
+                length = data_length(data)
+            if length is not None:
+                self.length = int(length)
+                self._start = self._tell(data)
+                return
+            read = data.read
+            data = iter(lambda: read(CHUNK_SIZE), '')
+
+        # an iterator - spool it to learn its length, memory use stays below SPOOL_MAX_SIZE
+        spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+        for chunk in data:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            spool.write(chunk)
+        self.length = spool.tell()
+        spool.seek(0)
+        self._file = spool
+        self._start = 0
+        self._spooled = True
+
+    def _tell(self, f):
+        try:
+            return f.tell()
+        except (AttributeError, IOError, OSError):
+            return None
+
+    def small_data(self):
+        """ Returns the whole body as a string if it is small enough to go out along with the headers """
+        if self._data is None or self.length > CHUNK_SIZE:
+            return None
+        if isinstance(self._data, memoryview):
+            return self._data.tobytes()
+        return str(self._data)
+
+    def chunks(self):
+        if self._data is not None:
+            for offset in xrange(0, self.length, CHUNK_SIZE):
+                yield self._data[offset:offset + CHUNK_SIZE]
+            return
+        remaining = self.length
+        while remaining > 0:
+            chunk = self._file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError('Request body ended %d bytes short of its length' % remaining)
+            remaining -= len(chunk)
+            yield chunk
+
+    def rewind(self):
+        """ Prepares the body to be sent again, returns False if it is a stream which can not be """
+        if self._file is None:
+            return True
+        if self._start is None:
+            return False
+        try:
+            self._file.seek(self._start)
+        except (AttributeError, IOError, OSError):
+            return False
+        return True
+
+    def close(self):
+        if self._spooled:
+            self._file.close()
+
 
 class CallingFormat:
     PATH = 1
@@ -141,19 +359,313 @@ class Location:
 
 
 
+class RetryPolicy:
+    """
+    How AWSAuthConnection retries failed requests (connection errors, timeouts and
+    5xx responses such as 503 SlowDown):
+
+    max_attempts     attempts per request, 1 disables retries
+    base_delay       backoff before the n-th retry is random(0, min(max_delay, base_delay * 2 ** n))
+    attempt_timeout  socket timeout of each attempt, so a stalled connection fails instead of hanging
+    deadline         total seconds a request may take across its attempts, None for no limit
+    budget_ratio     retry budget: every request which succeeds at once earns budget_ratio
+                     of a retry, and up to budget_max retries are banked. When an outage
+                     empties it, requests fail fast rather than multiplying the load.
+                     Hedges and the retries of multipart parts are paid from it as well
+    hedge_after      seconds after which an idempotent GET / HEAD still waiting for its
+                     response is sent a second time; the first response wins. None disables hedging
+
+    Counters are kept in self.counters, see AWSAuthConnection.get_stats()
+    """
+    RETRY_STATUSES = (500, 502, 503, 504)
+    HEDGED_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=5, attempt_timeout=60, deadline=None,
+                 budget_ratio=0.1, budget_max=10, hedge_after=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.hedge_after = hedge_after
+        self._budget = float(budget_max)
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'retries_denied': 0, 'hedges': 0, 'hedges_denied': 0, 'hedge_wins': 0}
+
+    def count(self, name, n=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] += n
+        finally:
+            self._lock.release()
+
+    def succeeded(self, attempts):
+        self._lock.acquire()
+        try:
+            self.counters['requests'] += 1
+            if attempts == 1:
+                self._budget = min(self.budget_max, self._budget + self.budget_ratio)
+        finally:
+            self._lock.release()
+
+    def timeout(self, start):
+        """ Socket timeout of an attempt of a request started at start """
+        if self.deadline is None:
+            return self.attempt_timeout
+        remaining = max(start + self.deadline - time.time(), 0.001)
+        if self.attempt_timeout is None:
+            return remaining
+        return min(self.attempt_timeout, remaining)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def spend(self, name):
+        """ Takes a request out of the budget for a retry (name 'retries') or a hedge ('hedges'), False when it is empty """
+        self._lock.acquire()
+        try:
+            if self._budget < 1:
+                self.counters[name + '_denied'] += 1
+                return False
+            self._budget -= 1
+            self.counters[name] += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def retry_delay(self, attempt, start):
+        """ Returns the backoff before retrying after the given attempt, or None if it should not be retried """
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if self.deadline is not None and time.time() + delay >= start + self.deadline:
+            return None
+        if not self.spend('retries'):
+            return None
+        return delay
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP(S) connections, kept per (host, is_secure).
+    max_size is the number of idle connections kept per host, idle connections older
+    than idle_timeout seconds are closed instead of being reused.
+    """
+    DEFAULT_MAX_SIZE = 10
+    DEFAULT_IDLE_TIMEOUT = 50
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, is_secure):
+        """
+            Returns (connection, reused). Idle connections are handed out most recently
+            used first, expired or stale ones are closed on the way
+        """
+        pool_key = (host, is_secure)
+        while True:
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(pool_key)
+                if not idle:
+                    break
+                connection, last_used = idle.pop()
+            finally:
+                self._lock.release()
+            if time.time() - last_used < self.idle_timeout and not self._is_stale(connection):
+                return connection, True
+            connection.close()
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if is_secure:
+            connection = httplib.HTTPSConnection(host, **kwargs)
+        else:
+            connection = httplib.HTTPConnection(host, **kwargs)
+        return connection, False
+
+    def release(self, host, is_secure, connection):
+        """ Puts back a connection whose last response was read in full """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((host, is_secure), [])
+            if len(idle) < self.max_size:
+                idle.append((connection, time.time()))
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+
+    def _is_stale(self, connection):
+        # An idle keep-alive socket should have nothing to read. If it is readable
+        # the server either closed it or sent something we did not ask for.
+        sock = connection.sock
+        if sock is None:
+            return True
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+
+class PooledHTTPResponse:
+    """
+    Wraps an httplib.HTTPResponse and hands its connection back to the pool
+    once the body was read in full. Closing it early drops the connection.
+    """
+    def __init__(self, http_response, pool, host, is_secure, connection):
+        self._response = http_response
+        self._pool = pool
+        self._host = host
+        self._is_secure = is_secure
+        self._connection = connection
+        # nothing to wait for on empty bodies (HEAD, 204), free the connection now
+        if http_response.length == 0:
+            self.read()
+
+    def read(self, amt=None):
+        try:
+            if amt is None:
+                data = self._response.read()
+            else:
+                data = self._response.read(amt)
+        except:
+            self._discard()
+            raise
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        self._response.close()
+        self._discard()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _release(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._response.will_close:
+            connection.close()
+        else:
+            self._pool.release(self._host, self._is_secure, connection)
+
+    def _discard(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+
+
+class WorkerJob:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        # the arguments may be large (e.g. the data of a part), do not keep them with the result
+        self.func = self.args = None
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """ Returns the result of the job, re-raising its exception in the calling thread """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            return None
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+    def done(self):
+        return self._done.isSet()
+
+
+class WorkerPool:
+    """
+    A fixed number of daemon threads running submitted jobs.
+    submit() blocks while max_pending jobs are waiting for a thread, which bounds
+    the memory held by queued work (e.g. multipart parts read ahead of the upload)
+    """
+    def __init__(self, workers, max_pending=None):
+        self._queue = Queue.Queue(max_pending or workers)
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        job = WorkerJob(func, args)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        """ Lets the queued jobs finish and stops the threads """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+
 class AWSAuthConnection:
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN, pool=None, signer=None,
+            retry_policy=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
 
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.signer = signer or Signer(aws_secret_access_key)
         self.is_secure = is_secure
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        # connections are reused across requests and threads
+        self.pool = pool or ConnectionPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def get_stats(self):
+        """ Returns the request, retry and hedge counters of this connection """
+        return self.retry_policy.counters.copy()
+
+    def close(self):
+        self.pool.close()
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -173,6 +685,52 @@ class AWSAuthConnection:
     def list_bucket(self, bucket, options={}, headers={}):
         return ListBucketResponse(self._make_request('GET', bucket, '', options, headers))
 
+    def iter_bucket(self, bucket, prefix='', delimiter=None, marker='', page_size=1000, headers={}):
+        """
+            Yields a BucketEntry for every key after marker under prefix, following the
+            listing from page to page. With a delimiter, keys rolled up into a common
+            prefix are yielded as a single BucketPrefix instead.
+            Each page is parsed while it is being read, so memory use does not depend
+            on the size of the bucket.
+        """
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+        if isinstance(marker, unicode):
+            marker = marker.encode('utf-8')
+        while True:
+            options = { 'max-keys': page_size }
+            if prefix:
+                options['prefix'] = prefix
+            if delimiter:
+                options['delimiter'] = delimiter
+            if marker:
+                options['marker'] = marker
+            response = StreamingGetResponse(self._make_request('GET', bucket, '', options, headers))
+            if response.http_response.status >= 300:
+                raise IOError('Could not list bucket %s: %s' % (bucket, response.message))
+
+            handler = IterBucketHandler()
+            parser = xml.sax.make_parser()
+            parser.setContentHandler(handler)
+            try:
+                for chunk in response.iter_content():
+                    parser.feed(chunk)
+                    for entry in handler.pop_entries():
+                        yield entry
+                parser.close()
+            finally:
+                response.close()
+            for entry in handler.pop_entries():
+                yield entry
+
+            # NextMarker is only sent along with a delimiter, otherwise the last key is the marker
+            marker = handler.next_marker or handler.last_name
+            if not handler.is_truncated or not marker:
+                return
+            if isinstance(marker, unicode):
+                # keys are parsed as unicode, query arguments are sent as utf-8
+                marker = marker.encode('utf-8')
+
     def delete_bucket(self, bucket, headers={}):
         return Response(self._make_request('DELETE', bucket, '', {}, headers))
 
@@ -194,10 +752,84 @@ class AWSAuthConnection:
         return GetResponse(
                 self._make_request('GET', bucket, key, {}, headers))
 
+    def get_stream(self, bucket, key, headers={}, byte_range=None):
+        """
+            Like get() but leaves the body on the wire, to be read through the returned
+            StreamingGetResponse. byte_range is a (start, end) tuple as taken by range_header()
+        """
+        if byte_range is not None:
+            headers = headers.copy()
+            headers['Range'] = range_header(*byte_range)
+        return StreamingGetResponse(
+                self._make_request('GET', bucket, key, {}, headers))
+
+    def get_to_file(self, bucket, key, sink, headers={}, byte_range=None):
+        """ Writes the object (or the byte_range of it) to sink, a file path or an object with write() """
+        response = self.get_stream(bucket, key, headers, byte_range)
+        if response.http_response.status < 300:
+            response.save_to(sink)
+        return response
+
     def delete(self, bucket, key, headers={}):
         return Response(
                 self._make_request('DELETE', bucket, key, {}, headers))
 
+    def delete_objects(self, bucket, keys, quiet=False, headers={}):
+        """
+            Deletes up to MAX_DELETE_KEYS keys (unicode, or UTF-8 encoded str) in one Multi-Object Delete request.
+            The keys of the response are unicode
+        """
+        body = ['<?xml version="1.0" encoding="UTF-8"?><Delete>']
+        if quiet:
+            body.append('<Quiet>true</Quiet>')
+        for key in keys:
+            if isinstance(key, str):
+                key = key.decode('utf-8')
+            body.append('<Object><Key>%s</Key></Object>' % xml_escape(key))
+        body.append('</Delete>')
+        body = u''.join(body).encode('utf-8')
+
+        headers = headers.copy()
+        headers['Content-MD5'] = base64.b64encode(md5.new(body).digest())
+        headers['Content-Type'] = 'application/xml'
+        return DeleteObjectsResponse(
+                self._make_request('POST', bucket, '', { 'delete': None }, headers, body))
+
+    def delete_many(self, bucket, keys, quiet=True):
+        """
+            Deletes any number of keys (a list or any iterable) in batches of MAX_DELETE_KEYS.
+            Returns a DeleteManyResult with the deleted keys and a DeleteError per key which failed,
+            the keys being the objects given (e.g. UTF-8 encoded str) rather than those S3 returned.
+            In quiet mode S3 only reports the failures, which keeps the responses small.
+        """
+        result = DeleteManyResult()
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == MAX_DELETE_KEYS:
+                self._delete_batch(bucket, batch, quiet, result)
+                batch = []
+        if batch:
+            self._delete_batch(bucket, batch, quiet, result)
+        return result
+
+    def _delete_batch(self, bucket, keys, quiet, result):
+        response = self.delete_objects(bucket, keys, quiet)
+        if response.http_response.status >= 300:
+            code = '%03d' % response.http_response.status
+            result.errors.extend([DeleteError(key, code, response.message) for key in keys])
+            return
+        # S3 answers with unicode keys, matched back to the ones given
+        given = dict([(isinstance(key, str) and key.decode('utf-8') or key, key) for key in keys])
+        for error in response.errors:
+            error.key = given.get(error.key, error.key)
+        result.errors.extend(response.errors)
+        if quiet:
+            failed = set([error.key for error in response.errors])
+            result.deleted.extend([key for key in keys if key not in failed])
+        else:
+            result.deleted.extend([given.get(key, key) for key in response.deleted])
+
     def get_bucket_logging(self, bucket, headers={}):
         return GetResponse(self._make_request('GET', bucket, '', { 'logging': None }, headers))
 
@@ -224,12 +856,19 @@ class AWSAuthConnection:
                     headers,
                     acl_xml_document))
 
-    def copy_object(self, source_bucket, source_key, destination_bucket, destination_key, headers={}):
-        headers['x-amz-copy-source'] = source_bucket + '/' + source_key
-        headers['x-amz-metadata-directive'] = 'REPLACE' if (source_bucket==destination_bucket and source_key==destination_key) else 'COPY'
-          
-        # _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={})
+    def head(self, bucket, key, headers={}):
         return Response(
+                self._make_request('HEAD', bucket, key, {}, headers))
+
+    def copy_object(self, source_bucket, source_key, destination_bucket, destination_key, headers={}, metadata_directive=None):
+        """
+            Copies an object on S3 without moving its data, up to MAX_COPY_SIZE bytes (see copy_multipart).
+            Check error_code as well as the status: S3 may fail a copy after answering 200
+        """
+        headers = copy_object_headers(source_bucket, source_key, destination_bucket, destination_key, headers, metadata_directive)
+
+        # _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={})
+        return CopyObjectResponse(
                 self._make_request(
                     'PUT',
                     destination_bucket,
@@ -237,6 +876,213 @@ class AWSAuthConnection:
                     {},
                     headers))
 
+    def initiate_multipart_upload(self, bucket, key, headers={}, metadata={}):
+        return InitiateMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploads': None }, headers, '', metadata))
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        return Response(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    headers,
+                    data))
+
+    def upload_part_copy(self, bucket, key, upload_id, part_number, source_bucket, source_key, byte_range=None, headers={}):
+        """ Copies a part from an existing object, byte_range is a (start, end) tuple of it as taken by range_header() """
+        headers = headers.copy()
+        headers['x-amz-copy-source'] = copy_source(source_bucket, source_key)
+        if byte_range is not None:
+            headers['x-amz-copy-source-range'] = range_header(*byte_range)
+        return CopyObjectResponse(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    headers))
+
+    # parts is a list of (part_number, etag)
+    def complete_multipart_upload(self, bucket, key, upload_id, parts, headers={}):
+        body = ['<CompleteMultipartUpload>']
+        for part_number, etag in sorted(parts):
+            body.append('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (part_number, xml_escape(etag)))
+        body.append('</CompleteMultipartUpload>')
+        return CompleteMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploadId': upload_id }, headers, ''.join(body)))
+
+    def abort_multipart_upload(self, bucket, key, upload_id, headers={}):
+        return Response(
+                self._make_request('DELETE', bucket, key, { 'uploadId': upload_id }, headers))
+
+    def list_parts(self, bucket, key, upload_id, options={}, headers={}):
+        query_args = options.copy()
+        query_args['uploadId'] = upload_id
+        return ListPartsResponse(self._make_request('GET', bucket, key, query_args, headers))
+
+    def list_all_parts(self, bucket, key, upload_id):
+        """ Returns all the uploaded parts of upload_id as a {part_number: Part} dict, following pagination """
+        parts = {}
+        options = {}
+        while True:
+            response = self.list_parts(bucket, key, upload_id, options)
+            if response.http_response.status >= 300:
+                raise IOError('Could not list parts of %s: %s' % (key, response.message))
+            for part in response.parts:
+                parts[part.part_number] = part
+            if not response.is_truncated:
+                return parts
+            options = { 'part-number-marker': response.next_part_number_marker }
+
+    def put_multipart(self, bucket, key, object, headers={}, part_size=DEFAULT_PART_SIZE,
+            workers=DEFAULT_PART_WORKERS, part_retries=DEFAULT_PART_RETRIES, upload_id=None):
+        """
+            Uploads object (anything put() accepts) as a multipart upload, sending up to
+            workers parts in parallel. Failed parts are retried on their own by the retry policy
+            (and up to part_retries times when S3 reports an error in the body of a 200 response).
+            Memory use is bounded by part_size * (workers * 2 + 1), whatever the size of the object:
+            a part is dropped once it is sent, only its number and ETag are kept.
+
+            Pass the upload_id of an interrupted upload to resume it: parts which were
+            already uploaded with the same content are not sent again.
+            On failure the upload is aborted (unless it was resumed) and the failing
+            Response is returned, otherwise the CompleteMultipartUploadResponse.
+        """
+        if not isinstance(object, S3Object):
+            object = S3Object(object)
+
+        length = data_length(object.data)
+        if length is not None and length > part_size * MAX_PARTS:
+            part_size = (length + MAX_PARTS - 1) / MAX_PARTS
+        part_size = max(part_size, MIN_PART_SIZE)
+
+        uploaded = {}
+        resumed = upload_id is not None
+        if resumed:
+            uploaded = self.list_all_parts(bucket, key, upload_id)
+        else:
+            response = self.initiate_multipart_upload(bucket, key, headers, object.metadata)
+            if response.http_response.status >= 300:
+                return response
+            upload_id = response.upload_id
+
+        pool = WorkerPool(workers)
+        # (part_number, etag) of the parts sent, and the jobs sending the others
+        parts = []
+        jobs = []
+        failed = None
+        try:
+            try:
+                for part_number, part in enumerate(iter_parts(object.data, part_size)):
+                    part_number += 1
+                    done = uploaded.get(part_number)
+                    if done and done.size == len(part) and done.etag.strip('"') == md5.new(part).hexdigest():
+                        parts.append((part_number, done.etag))
+                        continue
+                    jobs.append((part_number, pool.submit(self._upload_part_etag, part_retries, bucket, key, upload_id, part_number, part)))
+                    # drop the part before reading the next one
+                    part = None
+                    failed = self._collect_parts(jobs, parts, False)
+                    if failed is not None:
+                        break
+                if not parts and not jobs:
+                    # S3 needs at least one part, even for an empty object
+                    jobs.append((1, pool.submit(self._upload_part_etag, part_retries, bucket, key, upload_id, 1, '')))
+            finally:
+                pool.close()
+            failed = failed or self._collect_parts(jobs, parts, True)
+            if failed is not None:
+                if not resumed:
+                    self.abort_multipart_upload(bucket, key, upload_id)
+                return failed
+        except:
+            if not resumed:
+                self.abort_multipart_upload(bucket, key, upload_id)
+            raise
+
+        return self.complete_multipart_upload(bucket, key, upload_id, parts)
+
+    def _upload_part_etag(self, retries, bucket, key, upload_id, part_number, data):
+        """ Returns the ETag of the uploaded part, or the failing Response """
+        response = self._call_with_retries(retries, self.upload_part, bucket, key, upload_id, part_number, data)
+        if response.http_response.status >= 300:
+            return response
+        return response.http_response.getheader('etag')
+
+    def _collect_parts(self, jobs, parts, wait):
+        """
+            Moves the (part_number, etag) of the finished jobs (all of them if wait) from jobs
+            to parts. Returns the Response of a part which failed, None if none did
+        """
+        pending = []
+        for part_number, job in jobs:
+            if not wait and not job.done():
+                pending.append((part_number, job))
+                continue
+            result = job.wait()
+            if isinstance(result, Response):
+                return result
+            parts.append((part_number, result))
+        jobs[:] = pending
+        return None
+
+    def copy_multipart(self, source_bucket, source_key, bucket, key, size, headers={}, metadata={},
+            part_size=DEFAULT_COPY_PART_SIZE, workers=DEFAULT_PART_WORKERS, part_retries=DEFAULT_PART_RETRIES):
+        """
+            Copies an object of size bytes (as told by a HEAD request) with a multipart upload
+            whose parts are copied from ranges of it, for objects over MAX_COPY_SIZE.
+            headers and metadata are those of the new object, nothing is copied from the source.
+            On failure the upload is aborted and the failing Response is returned,
+            otherwise the CompleteMultipartUploadResponse.
+        """
+        part_size = min(max(part_size, (size + MAX_PARTS - 1) / MAX_PARTS, MIN_PART_SIZE), MAX_COPY_SIZE)
+
+        response = self.initiate_multipart_upload(bucket, key, headers, metadata)
+        if response.http_response.status >= 300:
+            return response
+        upload_id = response.upload_id
+
+        pool = WorkerPool(workers)
+        jobs = []
+        try:
+            try:
+                for part_number, start in enumerate(xrange(0, max(size, 1), part_size)):
+                    byte_range = (start, min(start + part_size, size) - 1) if size else None
+                    jobs.append((part_number + 1, pool.submit(self._call_with_retries, part_retries, self.upload_part_copy,
+                        bucket, key, upload_id, part_number + 1, source_bucket, source_key, byte_range)))
+            finally:
+                pool.close()
+
+            parts = []
+            for part_number, job in jobs:
+                response = job.wait()
+                if response.http_response.status >= 300 or response.error_code:
+                    self.abort_multipart_upload(bucket, key, upload_id)
+                    return response
+                parts.append((part_number, response.etag))
+        except:
+            self.abort_multipart_upload(bucket, key, upload_id)
+            raise
+
+        return self.complete_multipart_upload(bucket, key, upload_id, parts)
+
+    def _call_with_retries(self, retries, func, *args):
+        """
+            Calls func(*args), a request of a multipart upload, again when S3 reports an error in the body
+            of a 200 response (as UploadPartCopy may), up to retries times. 5xx answers and network errors
+            were already retried by the retry policy; these retries are paid from its budget too
+        """
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            response = func(*args)
+            if not getattr(response, 'error_code', None) or attempt >= retries or not policy.spend('retries'):
+                return response
+            attempt += 1
+            time.sleep(policy.backoff(attempt))
+
     def list_all_my_buckets(self, headers={}):
         return ListAllMyBucketsResponse(self._make_request('GET', '', '', {}, headers))
 
@@ -245,8 +1091,8 @@ class AWSAuthConnection:
 
     # end public methods
 
-    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
-
+    def request_target(self, bucket='', key='', query_args={}):
+        """ Returns the (server, path) a request is sent to """
         server = ''
         if bucket == '':
             server = self.server
@@ -273,35 +1119,158 @@ class AWSAuthConnection:
         if len(query_args):
             path += "?" + query_args_hash_to_string(query_args)
 
+        return server, path
+
+    def signed_headers(self, method, bucket='', key='', query_args={}, headers={}, metadata={}):
+        """ Returns the headers of a request along with its metadata and Date / Authorization headers """
+        final_headers = merge_meta(headers, metadata);
+        # add auth header
+        self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
+        return final_headers
+
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        server, path = self.request_target(bucket, key, query_args)
+
         is_secure = self.is_secure
         host = "%s:%d" % (server, self.port)
+        body = RequestBody(data, get_header(headers, 'Content-Length'))
+        try:
+            redirects = 0
+            while True:
+                final_headers = self.signed_headers(method, bucket, key, query_args, headers, metadata)
+
+                resp = self._send_with_retries(is_secure, host, method, path, body, final_headers)
+                if resp.status < 300 or resp.status >= 400:
+                    return resp
+                # handle redirect
+                location = resp.getheader('location')
+                if not location or redirects >= MAX_REDIRECTS or not body.rewind():
+                    return resp
+                redirects += 1
+                # (close connection)
+                resp.read()
+                scheme, host, path, params, query, fragment \
+                        = urlparse.urlparse(location)
+                if scheme == "http":    is_secure = False
+                elif scheme == "https": is_secure = True
+                else: raise httplib.InvalidURL("Not http/https: " + location)
+                if query: path += "?" + query
+                # retry with redirect
+        finally:
+            body.close()
+
+    def _send_with_retries(self, is_secure, host, method, path, body, headers):
+        policy = self.retry_policy
+        start = time.time()
+        attempt = 0
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
-            else:
-                connection = httplib.HTTPConnection(host)
-
-            final_headers = merge_meta(headers, metadata);
-            # add auth header
-            self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
-
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
-            if resp.status < 300 or resp.status >= 400:
+            attempt += 1
+            timeout = policy.timeout(start)
+            resp = exc_info = None
+            try:
+                if policy.hedge_after is not None and method in policy.HEDGED_METHODS:
+                    resp = self._send_hedged(is_secure, host, method, path, body, headers, timeout)
+                else:
+                    resp = self._send_request(is_secure, host, method, path, body, headers, timeout)
+            except (socket.error, httplib.HTTPException):
+                exc_info = sys.exc_info()
+
+            if resp is not None and resp.status not in policy.RETRY_STATUSES:
+                policy.succeeded(attempt)
                 return resp
-            # handle redirect
-            location = resp.getheader('location')
-            if not location:
+            delay = policy.retry_delay(attempt, start)
+            if delay is None or not body.rewind():
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
                 return resp
-            # (close connection)
-            resp.read()
-            scheme, host, path, params, query, fragment \
-                    = urlparse.urlparse(location)
-            if scheme == "http":    is_secure = True
-            elif scheme == "https": is_secure = False
-            else: raise invalidURL("Not http/https: " + location)
-            if query: path += "?" + query
-            # retry with redirect
+            if resp is not None:
+                # frees the connection for the next attempt
+                resp.read()
+            time.sleep(delay)
+
+    def _send_hedged(self, is_secure, host, method, path, body, headers, timeout):
+        """
+            Sends a bodyless request, and sends it again if no response came within
+            hedge_after seconds. Returns the first response, the other one is dropped.
+        """
+        policy = self.retry_policy
+        results = Queue.Queue()
+        def send(hedge):
+            try:
+                results.put((self._send_request(is_secure, host, method, path, body, headers.copy(), timeout), hedge, None))
+            except:
+                results.put((None, hedge, sys.exc_info()))
+        def drop_late_response():
+            resp, hedge, exc_info = results.get()
+            if resp is not None:
+                resp.close()
+
+        self._start_thread(send, False)
+        try:
+            first = results.get(timeout=policy.hedge_after)
+            return self._hedge_result(first)
+        except Queue.Empty:
+            pass
+        if not policy.spend('hedges'):
+            # a hedge is one more request, not sent when the budget is spent
+            return self._hedge_result(results.get())
+        self._start_thread(send, True)
+        first = results.get()
+        if first[0] is None:
+            # the first attempt to finish failed, the other one may still succeed
+            first = results.get()
+        else:
+            self._start_thread(drop_late_response)
+        if first[1] and first[0] is not None:
+            policy.count('hedge_wins')
+        return self._hedge_result(first)
+
+    def _hedge_result(self, result):
+        resp, hedge, exc_info = result
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return resp
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _send_request(self, is_secure, host, method, path, body, headers, timeout=None):
+        for name in headers.keys():
+            if name.lower() == 'content-length':
+                del headers[name]
+        headers['Content-Length'] = str(body.length)
+        while True:
+            connection, reused = self.pool.get(host, is_secure)
+            if timeout is not None:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+            try:
+                connection.putrequest(method, path, skip_accept_encoding=True)
+                for name, value in headers.items():
+                    connection.putheader(name, value)
+                small_data = body.small_data()
+                if small_data is not None:
+                    # headers and a small body go out in a single packet
+                    connection.endheaders(small_data)
+                else:
+                    connection.endheaders()
+                    for chunk in body.chunks():
+                        connection.send(chunk)
+                http_response = connection.getresponse()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                # the server may drop an idle keep-alive connection at any time,
+                # so a failure on a reused one is retried on the next connection
+                if reused and body.rewind():
+                    continue
+                raise
+            return PooledHTTPResponse(http_response, self.pool, host, is_secure, connection)
 
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
         if not headers.has_key('Date'):
@@ -309,7 +1278,7 @@ class AWSAuthConnection:
 
         c_string = canonical_string(method, bucket, key, query_args, headers)
         headers['Authorization'] = \
-            "AWS %s:%s" % (self.aws_access_key_id, encode(self.aws_secret_access_key, c_string))
+            "AWS %s:%s" % (self.aws_access_key_id, self.signer.sign(c_string))
 
 
 class QueryStringAuthGenerator:
@@ -317,13 +1286,14 @@ class QueryStringAuthGenerator:
     DEFAULT_EXPIRES_IN = 60
 
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-                 server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+                 server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN, signer=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
 
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.signer = signer or Signer(aws_secret_access_key)
         if (is_secure):
             self.protocol = 'https'
         else:
@@ -409,7 +1379,7 @@ class QueryStringAuthGenerator:
             raise "Invalid expires state"
 
         canonical_str = canonical_string(method, bucket, key, query_args, headers, expires)
-        encoded_canonical = encode(self.aws_secret_access_key, canonical_str)
+        encoded_canonical = self.signer.sign(canonical_str)
 
         url = CallingFormat.build_url_base(self.protocol, self.server, self.port, bucket, self.calling_format)
 
@@ -443,6 +1413,24 @@ class ListEntry:
         self.storage_class = storage_class
         self.owner = owner
 
+class BucketEntry(object):
+    """ A compact listing entry, as yielded by AWSAuthConnection.iter_bucket """
+    __slots__ = ('key', 'last_modified', 'etag', 'size', 'storage_class')
+
+    def __init__(self, key='', last_modified=None, etag='', size=0, storage_class=''):
+        self.key = key
+        self.last_modified = last_modified
+        self.etag = etag
+        self.size = size
+        self.storage_class = storage_class
+
+class BucketPrefix(object):
+    """ A common prefix, yielded by AWSAuthConnection.iter_bucket when a delimiter is given """
+    __slots__ = ('prefix',)
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
 class CommonPrefixEntry:
     def __init(self, prefix=''):
         self.prefix = prefix
@@ -452,6 +1440,24 @@ class Bucket:
         self.name = name
         self.creation_date = creation_date
 
+class DeleteError:
+    def __init__(self, key='', code='', message=''):
+        self.key = key
+        self.code = code
+        self.message = message
+
+class DeleteManyResult:
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+class Part:
+    def __init__(self, part_number=0, etag='', size=0, last_modified=None):
+        self.part_number = part_number
+        self.etag = etag
+        self.size = size
+        self.last_modified = last_modified
+
 class Response:
     def __init__(self, http_response):
         self.http_response = http_response
@@ -493,6 +1499,15 @@ class ListAllMyBucketsResponse(Response):
         else:
             self.entries = []
 
+def get_aws_metadata(headers):
+    metadata = {}
+    for hkey in headers.keys():
+        if hkey.lower().startswith(METADATA_PREFIX):
+            metadata[hkey[len(METADATA_PREFIX):]] = headers[hkey]
+            del headers[hkey]
+
+    return metadata
+
 class GetResponse(Response):
     def __init__(self, http_response):
         Response.__init__(self, http_response)
@@ -501,13 +1516,70 @@ class GetResponse(Response):
         self.object = S3Object(self.body, metadata)
 
     def get_aws_metadata(self, headers):
-        metadata = {}
-        for hkey in headers.keys():
-            if hkey.lower().startswith(METADATA_PREFIX):
-                metadata[hkey[len(METADATA_PREFIX):]] = headers[hkey]
-                del headers[hkey]
-
-        return metadata
+        return get_aws_metadata(headers)
+
+class StreamingGetResponse(Response):
+    """
+    A GET response whose body is read in pieces rather than held in memory.
+    Read it with read(), by iterating over it or with save_to(), and close() it
+    if it is not read to the end. Error bodies are read up front like Response does.
+    """
+    def __init__(self, http_response):
+        if http_response.status >= 300:
+            Response.__init__(self, http_response)
+            self.metadata = {}
+            return
+        self.http_response = http_response
+        self.body = None
+        self.message = "%03d %s" % (http_response.status, http_response.reason)
+        self.metadata = get_aws_metadata(http_response.msg)
+        length = http_response.getheader('content-length')
+        self.content_length = length is not None and int(length) or None
+        self.content_range = http_response.getheader('content-range')
+
+    def read(self, amt=None):
+        if self.body is not None:
+            body, self.body = self.body, ''
+            return body
+        return self.http_response.read(amt)
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        return self.iter_content()
+
+    def save_to(self, sink, chunk_size=CHUNK_SIZE):
+        """ Writes the body to sink, a file path or an object with write(). Returns the number of bytes written """
+        if not isinstance(sink, basestring):
+            return self._copy_to(sink, chunk_size)
+        f = open(sink, 'wb')
+        try:
+            try:
+                return self._copy_to(f, chunk_size)
+            finally:
+                f.close()
+        except:
+            os.remove(sink)
+            raise
+
+    def _copy_to(self, f, chunk_size):
+        written = 0
+        try:
+            for chunk in self.iter_content(chunk_size):
+                f.write(chunk)
+                written += len(chunk)
+        except:
+            self.close()
+            raise
+        return written
+
+    def close(self):
+        self.http_response.close()
 
 class LocationResponse(Response):
     def __init__(self, http_response):
@@ -521,7 +1593,7 @@ class ListBucketHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.entries = []
         self.curr_entry = None
-        self.curr_text = ''
+        self.curr_text = []
         self.common_prefixes = []
         self.curr_common_prefix = None
         self.name = ''
@@ -543,46 +1615,106 @@ class ListBucketHandler(xml.sax.ContentHandler):
 
 
     def endElement(self, name):
+        curr_text = ''.join(self.curr_text)
         if name == 'Contents':
             self.entries.append(self.curr_entry)
         elif name == 'CommonPrefixes':
             self.common_prefixes.append(self.curr_common_prefix)
         elif name == 'Key':
-            self.curr_entry.key = self.curr_text
+            self.curr_entry.key = curr_text
         elif name == 'LastModified':
-            self.curr_entry.last_modified = self.curr_text
+            self.curr_entry.last_modified = curr_text
         elif name == 'ETag':
-            self.curr_entry.etag = self.curr_text
+            self.curr_entry.etag = curr_text
         elif name == 'Size':
-            self.curr_entry.size = int(self.curr_text)
+            self.curr_entry.size = int(curr_text)
         elif name == 'ID':
-            self.curr_entry.owner.id = self.curr_text
+            self.curr_entry.owner.id = curr_text
         elif name == 'DisplayName':
-            self.curr_entry.owner.display_name = self.curr_text
+            self.curr_entry.owner.display_name = curr_text
         elif name == 'StorageClass':
-            self.curr_entry.storage_class = self.curr_text
+            self.curr_entry.storage_class = curr_text
         elif name == 'Name':
-            self.name = self.curr_text
+            self.name = curr_text
         elif name == 'Prefix' and self.is_echoed_prefix_set:
-            self.curr_common_prefix.prefix = self.curr_text
+            self.curr_common_prefix.prefix = curr_text
         elif name == 'Prefix':
-            self.prefix = self.curr_text
+            self.prefix = curr_text
             self.is_echoed_prefix_set = True
         elif name == 'Marker':
-            self.marker = self.curr_text
+            self.marker = curr_text
         elif name == 'IsTruncated':
-            self.is_truncated = self.curr_text == 'true'
+            self.is_truncated = curr_text == 'true'
         elif name == 'Delimiter':
-            self.delimiter = self.curr_text
+            self.delimiter = curr_text
         elif name == 'MaxKeys':
-            self.max_keys = int(self.curr_text)
+            self.max_keys = int(curr_text)
         elif name == 'NextMarker':
-            self.next_marker = self.curr_text
+            self.next_marker = curr_text
 
-        self.curr_text = ''
+        self.curr_text = []
 
     def characters(self, content):
-        self.curr_text += content
+        self.curr_text.append(content)
+
+
+class IterBucketHandler(xml.sax.ContentHandler):
+    """
+    Parses a ListBucketResult incrementally into BucketEntry / BucketPrefix objects.
+    Entries pile up in self.entries until the caller takes them with pop_entries()
+    """
+    def __init__(self):
+        self.entries = []
+        self.curr_entry = None
+        self.curr_text = []
+        self.in_common_prefixes = False
+        self.is_truncated = False
+        self.next_marker = ''
+        self.last_name = ''
+
+    def pop_entries(self):
+        entries, self.entries = self.entries, []
+        return entries
+
+    def startElement(self, name, attrs):
+        if name == 'Contents':
+            self.curr_entry = BucketEntry()
+        elif name == 'CommonPrefixes':
+            self.in_common_prefixes = True
+        self.curr_text = []
+
+    def endElement(self, name):
+        entry = self.curr_entry
+        if entry is not None:
+            if name == 'Key':
+                entry.key = ''.join(self.curr_text)
+            elif name == 'LastModified':
+                entry.last_modified = ''.join(self.curr_text)
+            elif name == 'ETag':
+                entry.etag = ''.join(self.curr_text)
+            elif name == 'Size':
+                entry.size = int(''.join(self.curr_text))
+            elif name == 'StorageClass':
+                entry.storage_class = ''.join(self.curr_text)
+            elif name == 'Contents':
+                self.entries.append(entry)
+                self.last_name = entry.key
+                self.curr_entry = None
+        elif self.in_common_prefixes:
+            if name == 'Prefix':
+                prefix = ''.join(self.curr_text)
+                self.entries.append(BucketPrefix(prefix))
+                self.last_name = prefix
+            elif name == 'CommonPrefixes':
+                self.in_common_prefixes = False
+        elif name == 'IsTruncated':
+            self.is_truncated = ''.join(self.curr_text) == 'true'
+        elif name == 'NextMarker':
+            self.next_marker = ''.join(self.curr_text)
+        self.curr_text = []
+
+    def characters(self, content):
+        self.curr_text.append(content)
 
 
 class ListAllMyBucketsHandler(xml.sax.ContentHandler):
@@ -607,6 +1739,157 @@ class ListAllMyBucketsHandler(xml.sax.ContentHandler):
         self.curr_text = content
 
 
+class InitiateMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.upload_id = None
+        if http_response.status < 300:
+            handler = TextHandler(('UploadId',))
+            xml.sax.parseString(self.body, handler)
+            self.upload_id = handler.values.get('UploadId')
+
+class CompleteMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.error_code = None
+        if http_response.status < 300:
+            # S3 may report a failure with a 200 status once the upload started
+            handler = TextHandler(('Location', 'ETag', 'Code', 'Message'))
+            xml.sax.parseString(self.body, handler)
+            self.location = handler.values.get('Location')
+            self.etag = handler.values.get('ETag')
+            self.error_code = handler.values.get('Code')
+            if self.error_code:
+                self.message = handler.values.get('Message') or self.error_code
+
+class CopyObjectResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.error_code = None
+        self.etag = None
+        if http_response.status < 300:
+            # S3 may report a failure with a 200 status once the copy started
+            handler = TextHandler(('ETag', 'LastModified', 'Code', 'Message'))
+            xml.sax.parseString(self.body, handler)
+            self.etag = handler.values.get('ETag')
+            self.last_modified = handler.values.get('LastModified')
+            self.error_code = handler.values.get('Code')
+            if self.error_code:
+                self.message = handler.values.get('Message') or self.error_code
+
+class ListPartsResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = ListPartsHandler()
+            xml.sax.parseString(self.body, handler)
+            self.parts = handler.parts
+            self.is_truncated = handler.is_truncated
+            self.next_part_number_marker = handler.next_part_number_marker
+        else:
+            self.parts = []
+            self.is_truncated = False
+
+class DeleteObjectsResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = DeleteObjectsHandler()
+            xml.sax.parseString(self.body, handler)
+            self.deleted = handler.deleted
+            self.errors = handler.errors
+        else:
+            self.deleted = []
+            self.errors = []
+
+class TextHandler(xml.sax.ContentHandler):
+    """ Collects the text of the given elements, for responses holding a handful of values """
+    def __init__(self, names):
+        self.names = names
+        self.values = {}
+        self.curr_text = None
+
+    def startElement(self, name, attrs):
+        if name in self.names:
+            self.curr_text = []
+
+    def endElement(self, name):
+        if name in self.names and self.curr_text is not None:
+            self.values[name] = ''.join(self.curr_text)
+        self.curr_text = None
+
+    def characters(self, content):
+        if self.curr_text is not None:
+            self.curr_text.append(content)
+
+class ListPartsHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.parts = []
+        self.curr_part = None
+        self.curr_text = []
+        self.is_truncated = False
+        self.next_part_number_marker = None
+
+    def startElement(self, name, attrs):
+        if name == 'Part':
+            self.curr_part = Part()
+        self.curr_text = []
+
+    def endElement(self, name):
+        text = ''.join(self.curr_text)
+        if name == 'Part':
+            self.parts.append(self.curr_part)
+            self.curr_part = None
+        elif self.curr_part is not None:
+            if name == 'PartNumber':
+                self.curr_part.part_number = int(text)
+            elif name == 'ETag':
+                self.curr_part.etag = text
+            elif name == 'Size':
+                self.curr_part.size = int(text)
+            elif name == 'LastModified':
+                self.curr_part.last_modified = text
+        elif name == 'IsTruncated':
+            self.is_truncated = text == 'true'
+        elif name == 'NextPartNumberMarker':
+            self.next_part_number_marker = text
+        self.curr_text = []
+
+    def characters(self, content):
+        self.curr_text.append(content)
+
+class DeleteObjectsHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+        self.curr_error = None
+        self.curr_key = None
+        self.curr_text = []
+
+    def startElement(self, name, attrs):
+        if name == 'Error':
+            self.curr_error = DeleteError()
+        self.curr_text = []
+
+    def endElement(self, name):
+        text = ''.join(self.curr_text)
+        if name == 'Key':
+            self.curr_key = text
+        elif name == 'Deleted':
+            self.deleted.append(self.curr_key)
+        elif name == 'Error':
+            self.curr_error.key = self.curr_key
+            self.errors.append(self.curr_error)
+            self.curr_error = None
+        elif name == 'Code' and self.curr_error is not None:
+            self.curr_error.code = text
+        elif name == 'Message' and self.curr_error is not None:
+            self.curr_error.message = text
+        self.curr_text = []
+
+    def characters(self, content):
+        self.curr_text.append(content)
+
 class LocationHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.location = None
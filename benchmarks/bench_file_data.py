@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Row size and load time of file_data, stored plain (before) and through s3mixin's
+filedata codec (after), on an in-memory sqlite table shaped like an S3Mixin model.
+
+"load" fetches every row, as a queryset of S3Mixin rows does; "load+read" also
+decodes file_data of each row, the cost paid by rows whose file_data is rendered.
+
+    python benchmarks/bench_file_data.py [rows]
+"""
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plupload-s3mixin'))
+import filedata
+
+CSS_RULE = '.%s-%d { margin: %dpx %dpx; padding: 0 %dpx; color: #%06x; font: %dpx/1.4 Helvetica, Arial, sans-serif; }\n'
+HTML_BLOCK = ('<div class="portfolio-item item-%d">\n  <a href="/portfolio/%d/" title="Project %d">\n'
+              '    <img src="http://bucket.s3.amazonaws.com/%d/%f/image.jpg" alt="Project %d" />\n'
+              '  </a>\n  <p class="caption">%s</p>\n</div>\n')
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt'.split()
+
+
+def sample(rnd):
+    """ A stylesheet or a page of 5-60KB, like the .css / .html files kept in file_data """
+    if rnd.random() < 0.5:
+        return ''.join([CSS_RULE % (rnd.choice(WORDS), i, rnd.randint(0, 40), rnd.randint(0, 40), rnd.randint(0, 20),
+                                    rnd.randint(0, 0xffffff), rnd.randint(10, 24)) for i in xrange(rnd.randint(40, 500))])
+    return '<html><body>\n%s</body></html>\n' % ''.join([HTML_BLOCK % (i, i, i, rnd.randint(1, 1000), rnd.random() * 1e9, i,
+        ' '.join(rnd.sample(WORDS, 6))) for i in xrange(rnd.randint(20, 200))])
+
+
+def table(rows, encode):
+    db = sqlite3.connect(':memory:')
+    db.text_factory = str
+    db.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, file TEXT, file_data TEXT)')
+    db.executemany('INSERT INTO item VALUES (?, ?, ?)', [(i, 'http://bucket.s3.amazonaws.com/%d/page.html' % i, encode(data))
+                                                          for i, data in enumerate(rows)])
+    size = db.execute('SELECT SUM(LENGTH(file_data)) FROM item').fetchone()[0]
+    return db, size
+
+
+def load(db, decode=None, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for row in db.execute('SELECT id, file, file_data FROM item'):
+            if decode is not None:
+                decode(row[2])
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    rnd = random.Random(42)
+    rows = [sample(rnd) for i in xrange(count)]
+    plain, plain_size = table(rows, lambda data: data)
+    packed, packed_size = table(rows, filedata.encode)
+    print '%d rows' % count
+    print '%-10s %12s %12s' % ('', 'before', 'after')
+    print '%-10s %11.1fK %11.1fK   (%.1fx smaller)' % ('avg size', plain_size / 1024.0 / count, packed_size / 1024.0 / count,
+                                                        float(plain_size) / packed_size)
+    print '%-10s %11.1fms %10.1fms' % ('load', load(plain) * 1000, load(packed) * 1000)
+    print '%-10s %11.1fms %10.1fms' % ('load+read', load(plain, filedata.decode) * 1000, load(packed, filedata.decode) * 1000)
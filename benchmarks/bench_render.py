@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Renders per second of a gallery, rendered the way render_visible() did before
+the mime index and render dispatch table (before), per item through
+utils.get_render_string_by_extension (after) and in one pass with utils.render_many.
+Needs Django on the path, the S3 / CDN settings are made up.
+
+    python benchmarks/bench_render.py [items]
+"""
+import mimetypes
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plupload-s3mixin'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(AWS_PREFIX='http://bucket.s3.amazonaws.com/', AWS_CLOUDFRONT='http://cdn.example.com/',
+                       AWS_DNS_ROTATOR=4, THUMBNAIL_SERVICE='http://thumbs.example.com/', ON_PRODUCTION_SERVER=True)
+from django.forms.util import flatatt
+from django.utils.safestring import mark_safe
+
+import utils
+
+EXTENSIONS = ['.jpg', '.jpg', '.jpg', '.png', '.gif', '.pdf', '.swf', '.mp3', '.css', '.js']
+
+
+class Item:
+    """ The attributes of an S3Mixin instance that rendering reads """
+    def __init__(self, i, extension):
+        self.file = 'http://bucket.s3.amazonaws.com/%d/%f/file-%d%s' % (i % 50, 1300000000 + i * 7.3, i, extension)
+        self.name = 'file-%d%s' % (i, extension)
+        self.file_data = None
+
+    def size(self):
+        return None, None
+
+
+def legacy_get_render_string(mime_type, params, only_visibles=False):
+    attrs = {}
+    if mime_type in utils.RENDER_MIMES:
+        render_mime_type = mime_type if not only_visibles or mime_type in utils.VISIBLE_MIMES else '*'
+    else:
+        for key, value in utils.RENDER_MIMES.items():
+            if mime_type.startswith(key):
+                render_mime_type = key if not only_visibles or key in utils.VISIBLE_MIMES else '*'
+                break
+        else:
+            render_mime_type = '*'
+    if only_visibles:
+        if render_mime_type == '*':
+            c = mime_type.partition('/')[0]
+        else:
+            c = render_mime_type.partition('/')[0] if '/' in render_mime_type else render_mime_type
+        attrs['class'] = c
+    params['attrs'] = flatatt(attrs)
+    if 'thumb' not in params: params['thumb'] = ''
+    if 'file_base' not in params: params['file_base'] = os.path.splitext(os.path.basename(params['file']))[0]
+    return mark_safe(utils.RENDER_MIMES[render_mime_type] % params)
+
+
+def legacy_get_render_string_by_extension(file_name, params, only_visibles=False):
+    if '?' in file_name: file_name = file_name[:file_name.index('?')]
+    mime_type = mimetypes.guess_type(file_name)[0]
+    if not mime_type:
+        mime_type = 'application'
+    return legacy_get_render_string(mime_type, params, only_visibles)
+
+
+def before(items):
+    rewriter = utils.get_url_rewriter()
+    return [legacy_get_render_string_by_extension(rewriter.cdn_url(item.file), {'file': rewriter.cdn_url(item.file), 'name': item.name}, True)
+            for item in items]
+
+
+def after(items):
+    rewriter = utils.get_url_rewriter()
+    return [utils.get_render_string_by_extension(rewriter.cdn_url(item.file), {'file': rewriter.cdn_url(item.file), 'name': item.name}, True)
+            for item in items]
+
+
+def many(items):
+    return utils.render_many(items, 'visible')
+
+
+def run(name, func, items, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(items)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print '%-12s %10.0f renders/s' % (name, len(items) / best)
+    return len(items) / best
+
+
+if __name__ == '__main__':
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    rnd = random.Random(42)
+    items = [Item(i, rnd.choice(EXTENSIONS)) for i in xrange(count)]
+    assert before(items) == after(items) == many(items)
+    slow = run('before', before, items)
+    run('after', after, items)
+    fast = run('render_many', many, items)
+    print 'speedup      %10.2fx' % (fast / slow)
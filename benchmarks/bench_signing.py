@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Signatures per second for a typical upload request, before and after S3.Signer.
+
+"before" is the original code path: canonical_string built with += over the
+sorted headers and a fresh hmac.new() keyed from the secret for every request.
+"after" is S3.canonical_string + a shared S3.Signer.
+
+    python benchmarks/bench_signing.py [iterations]
+"""
+import base64
+import hmac
+import os
+import sha
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import S3
+
+SECRET = 'wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY'
+HEADERS = {
+    'Date': 'Tue, 27 Mar 2007 19:36:42 +0000',
+    'Content-Type': 'image/jpeg',
+    'Cache-Control': 'public, max-age=2629743',
+    'x-amz-acl': 'public-read',
+    'x-amz-meta-author': 'plupload',
+}
+KEY = 'accounts/userprofile/42/1300000000.0/avatar.jpg'
+
+
+def legacy_canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
+    interesting_headers = {}
+    for header_key in headers:
+        lk = header_key.lower()
+        if lk in ['content-md5', 'content-type', 'date'] or lk.startswith(S3.AMAZON_HEADER_PREFIX):
+            interesting_headers[lk] = headers[header_key].strip()
+    if not interesting_headers.has_key('content-type'):
+        interesting_headers['content-type'] = ''
+    if not interesting_headers.has_key('content-md5'):
+        interesting_headers['content-md5'] = ''
+    if interesting_headers.has_key('x-amz-date'):
+        interesting_headers['date'] = ''
+    if expires:
+        interesting_headers['date'] = str(expires)
+    sorted_header_keys = interesting_headers.keys()
+    sorted_header_keys.sort()
+    buf = "%s\n" % method
+    for header_key in sorted_header_keys:
+        if header_key.startswith(S3.AMAZON_HEADER_PREFIX):
+            buf += "%s:%s\n" % (header_key, interesting_headers[header_key])
+        else:
+            buf += "%s\n" % interesting_headers[header_key]
+    if bucket != "":
+        buf += "/%s" % bucket
+    buf += "/%s" % urllib.quote_plus(key)
+    return buf
+
+
+def legacy_encode(aws_secret_access_key, str):
+    return base64.encodestring(hmac.new(aws_secret_access_key, str, sha).digest()).strip()
+
+
+def before():
+    return legacy_encode(SECRET, legacy_canonical_string('PUT', 'bucket', KEY, {}, HEADERS))
+
+
+signer = S3.Signer(SECRET)
+def after():
+    return signer.sign(S3.canonical_string('PUT', 'bucket', KEY, {}, HEADERS))
+
+
+def run(name, func, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        func()
+    elapsed = time.time() - start
+    print '%-8s %10.0f signatures/s' % (name, iterations / elapsed)
+    return iterations / elapsed
+
+
+if __name__ == '__main__':
+    iterations = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    assert before() == after()
+    slow = run('before', before, iterations)
+    fast = run('after', after, iterations)
+    print 'speedup  %10.2fx' % (fast / slow)
@@ -0,0 +1,160 @@
+# Python imports
+import logging
+import time
+
+# Django imports
+from django.conf import settings
+
+import S3
+from s3mixin.models import get_aws_connection
+
+DEFAULT_WORKERS = 16
+
+class PutJob:
+    def __init__(self, bucket, key, data, headers={}):
+        self.bucket = bucket
+        self.key = key
+        self.data = data
+        self.headers = headers
+
+    def run(self, connection):
+        # measured before put() consumes a stream
+        length = S3.data_length(self.data) or 0
+        response = connection.put(self.bucket, self.key, self.data, self.headers)
+        return response, length
+
+class GetJob:
+    """ Downloads key into sink (a file path or an object with write()), or into memory if sink is None """
+    def __init__(self, bucket, key, sink=None, headers={}):
+        self.bucket = bucket
+        self.key = key
+        self.sink = sink
+        self.headers = headers
+
+    def run(self, connection):
+        if self.sink is None:
+            response = connection.get(self.bucket, self.key, self.headers)
+            return response, len(response.body or '')
+        response = connection.get_stream(self.bucket, self.key, self.headers)
+        if response.http_response.status >= 300:
+            return response, 0
+        return response, response.save_to(self.sink)
+
+class CopyJob:
+    def __init__(self, source_bucket, source_key, bucket, key, headers={}):
+        self.source_bucket = source_bucket
+        self.source_key = source_key
+        self.bucket = bucket
+        self.key = key
+        self.headers = headers
+
+    def run(self, connection):
+        return connection.copy_object(self.source_bucket, self.source_key, self.bucket, self.key, self.headers), 0
+
+class DeleteJob:
+    def __init__(self, bucket, key, headers={}):
+        self.bucket = bucket
+        self.key = key
+        self.headers = headers
+
+    def run(self, connection):
+        return connection.delete(self.bucket, self.key, self.headers), 0
+
+class BulkItemResult:
+    """ response is the S3 Response of a job, or whatever func returned for BulkExecutor.map """
+    def __init__(self, job, response=None, bytes=0, error=None, elapsed=0):
+        self.job = job
+        self.response = response
+        self.bytes = bytes
+        self.error = error
+        self.elapsed = elapsed
+
+    def ok(self):
+        if self.error is not None:
+            return False
+        if not isinstance(self.response, S3.Response):
+            return True
+        return self.response.http_response.status < 300 and not getattr(self.response, 'error_code', None)
+
+class BulkResult:
+    def __init__(self, items, elapsed):
+        self.items = items
+        self.elapsed = elapsed
+        self.bytes = sum([item.bytes for item in items])
+        self.failed = [item for item in items if not item.ok()]
+
+    def ops_per_second(self):
+        return self.elapsed and len(self.items) / self.elapsed or 0
+
+    def bytes_per_second(self):
+        return self.elapsed and self.bytes / self.elapsed or 0
+
+    def __unicode__(self):
+        return u'%d operations (%d failed) in %.2fs: %.1f ops/s, %.1f KB/s' % (
+            len(self.items), len(self.failed), self.elapsed, self.ops_per_second(), self.bytes_per_second() / 1024)
+
+class BulkExecutor:
+    """
+    Runs batches of S3 jobs (PutJob, GetJob, CopyJob, DeleteJob) on a bounded pool
+    of threads sharing the pooled keep-alive connections of one AWSAuthConnection.
+    Unless one is given, the executor has a connection of its own, keeping a keep-alive
+    connection per worker, with the credentials and retry policy of the shared one.
+    Jobs may be any iterable, they are consumed as threads free up.
+
+        result = BulkExecutor().run(DeleteJob(settings.AWS_BUCKET, key) for key in keys)
+        logging.info(unicode(result))
+
+    For plain deletes AWSAuthConnection.delete_many is cheaper still.
+    """
+    def __init__(self, connection=None, workers=None):
+        self.workers = workers or getattr(settings, 'AWS_BULK_WORKERS', DEFAULT_WORKERS)
+        self._own_connection = connection is None
+        if connection is None:
+            # the shared pool keeps fewer idle connections than we have workers, leave it as it is
+            shared = get_aws_connection()
+            connection = S3.AWSAuthConnection(shared.aws_access_key_id, shared.aws_secret_access_key,
+                shared.is_secure, shared.server, shared.port, shared.calling_format,
+                pool=S3.ConnectionPool(max(shared.pool.max_size, self.workers), shared.pool.idle_timeout, shared.pool.timeout),
+                signer=shared.signer, retry_policy=shared.retry_policy)
+        self.connection = connection
+
+    def close(self):
+        """ Closes the idle connections of the executor's own connection, a given one is left open """
+        if self._own_connection:
+            self.connection.close()
+
+    def run(self, jobs):
+        """ Returns a BulkResult holding a BulkItemResult per job, in the order of jobs """
+        return self._execute(self._run_job, jobs)
+
+    def map(self, func, items):
+        """
+            Calls func(item) for each item on the pool, e.g. to upload many S3Mixin rows:
+                executor.map(lambda row: row.upload_file_to_s3(), rows)
+        """
+        return self._execute(lambda item: (func(item), 0), items)
+
+    def _execute(self, func, items):
+        start = time.time()
+        pool = S3.WorkerPool(self.workers, self.workers * 2)
+        pending = []
+        try:
+            for item in items:
+                pending.append(pool.submit(self._timed, func, item))
+        finally:
+            pool.close()
+        result = BulkResult([job.wait() for job in pending], time.time() - start)
+        logging.info('s3mixin bulk: %s' % unicode(result))
+        return result
+
+    def _run_job(self, job):
+        return job.run(self.connection)
+
+    def _timed(self, func, item):
+        start = time.time()
+        try:
+            response, bytes = func(item)
+        except Exception, e:
+            logging.exception(e)
+            return BulkItemResult(item, error=e, elapsed=time.time() - start)
+        return BulkItemResult(item, response, bytes, elapsed=time.time() - start)
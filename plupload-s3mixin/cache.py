@@ -0,0 +1,139 @@
+"""
+Memoizes the HTML of S3Mixin.render / render_visible / render_thumb, keyed by
+(file, name, mode, size). The backend is picked by settings.AWS_RENDER_CACHE:
+'lru' (the default) keeps settings.AWS_RENDER_CACHE_SIZE entries per process,
+'django' uses the Django cache (settings.AWS_RENDER_CACHE_TIMEOUT seconds) and
+None disables the cache.
+"""
+# Python imports
+import itertools
+import md5
+import threading
+import time
+from collections import OrderedDict
+
+# Django imports
+from django.conf import settings
+
+DEFAULT_SIZE = 10000
+DEFAULT_TIMEOUT = 24 * 60 * 60
+
+class LRUBackend:
+    """ Keeps the max_size most recently used entries of this process """
+    def __init__(self, max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+class DjangoBackend:
+    """ Shares entries between processes through the Django cache """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value):
+        self.cache.set(self._key(key), value, self.timeout)
+
+    def clear(self):
+        # entries expire on their own, or are left behind by a new version of their file
+        pass
+
+    def _key(self, key):
+        # cache keys are short ascii strings
+        return 's3mixin:render:' + md5.new(repr(key)).hexdigest()
+
+class RenderCache:
+    """
+    Entries of a file are keyed with its current version, so invalidate(file)
+    makes all of them unreachable at once, whatever their name / mode / size
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._versions = itertools.count()
+
+    def get_or_render(self, file, key, render):
+        """ Returns the cached HTML of key, or stores what render() returns. Nothing is cached for an empty file """
+        if not file:
+            return render()
+        key = (file, self.backend.get(('version', file))) + tuple(key)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = render()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, file):
+        if file:
+            self.backend.set(('version', file), '%s.%s' % (time.time(), self._versions.next()))
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': total and float(self.hits) / total or 0}
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+def get_render_cache():
+    """ Returns the process wide RenderCache, or None when settings.AWS_RENDER_CACHE disables it """
+    global _render_cache
+    if _render_cache is None:
+        _render_cache_lock.acquire()
+        try:
+            if _render_cache is None:
+                kind = getattr(settings, 'AWS_RENDER_CACHE', 'lru')
+                if kind == 'lru':
+                    backend = LRUBackend(getattr(settings, 'AWS_RENDER_CACHE_SIZE', DEFAULT_SIZE))
+                elif kind == 'django':
+                    backend = DjangoBackend(getattr(settings, 'AWS_RENDER_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+                elif kind is None:
+                    backend = None
+                else:
+                    raise ValueError('Unknown AWS_RENDER_CACHE %r' % kind)
+                # False remembers that the cache is disabled
+                _render_cache = RenderCache(backend) if backend is not None else False
+        finally:
+            _render_cache_lock.release()
+    return _render_cache or None
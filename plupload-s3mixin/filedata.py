@@ -0,0 +1,42 @@
+"""
+Storage format of S3Mixin.file_data. Values worth it are kept zlib compressed and
+base64'ed behind MARKER, anything else as plain text, so rows written before
+compression existed read unchanged.
+"""
+# Python imports
+import base64
+import zlib
+
+MARKER = 'zlib:'
+# shorter values are not worth compressing
+MIN_SIZE = 512
+LEVEL = 6
+
+def encode(value):
+    """
+        Returns the stored form of value (a string or None). Like Django does for any text,
+        str values which are not UTF-8 raise UnicodeDecodeError, whatever their length
+    """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value.decode('utf-8')
+    if len(value) < MIN_SIZE and not value.startswith(MARKER):
+        return value
+    compressed = MARKER + base64.b64encode(zlib.compress(value, LEVEL))
+    if len(compressed) >= len(value) and not value.startswith(MARKER):
+        return value
+    return compressed
+
+def decode(stored):
+    """ Returns the value of a stored string, as unicode """
+    if stored and stored.startswith(MARKER):
+        return zlib.decompress(base64.b64decode(stored[len(MARKER):])).decode('utf-8')
+    if isinstance(stored, str):
+        return stored.decode('utf-8')
+    return stored
+
+def is_encoded(stored):
+    return bool(stored) and stored.startswith(MARKER)
@@ -0,0 +1,56 @@
+# Python imports
+from optparse import make_option
+
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+
+from s3mixin.models import S3Mixin
+from s3mixin import filedata
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Compresses the file_data of existing rows of S3Mixin models (all of them unless given)'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=200,
+            help='Rows read per query'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report how much would be saved'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            models = []
+            for name in args:
+                model = get_model(*name.split('.', 1))
+                if model is None or not issubclass(model, S3Mixin):
+                    raise CommandError('%s is not an S3Mixin model' % name)
+                models.append(model)
+        else:
+            models = [model for model in get_models() if issubclass(model, S3Mixin)]
+        for model in models:
+            rows, before, after = self.compress(model, options['batch_size'], options['dry_run'])
+            self.stdout.write('%s.%s: %d rows, file_data %d -> %d bytes\n' % (
+                model._meta.app_label, model._meta.object_name, rows, before, after))
+
+    def compress(self, model, batch_size, dry_run):
+        rows = before = after = 0
+        manager = model._default_manager
+        queryset = manager.filter(file_data__isnull=False).order_by('pk')
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', 'file_data')[:batch_size])
+            if not batch:
+                return rows, before, after
+            for pk, raw in batch:
+                if filedata.is_encoded(raw):
+                    continue
+                encoded = filedata.encode(raw)
+                rows += 1
+                before += len(raw.encode('utf-8') if isinstance(raw, unicode) else raw)
+                after += len(encoded)
+                # only rewrite the row if file_data did not change meanwhile (lookups compare the stored form)
+                if not dry_run and filedata.is_encoded(encoded):
+                    manager.filter(pk=pk, file_data=raw).update(file_data=encoded)
+            last_pk = batch[-1][0]
@@ -0,0 +1,28 @@
+# Python imports
+import time
+from optparse import make_option
+
+# Django imports
+from django.core.management.base import BaseCommand
+
+from s3mixin.models import S3Tombstone
+
+class Command(BaseCommand):
+    help = 'Deletes the S3 objects recorded by S3Tombstone, in batches of up to 1000 keys'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Keys per S3 delete request (at most 1000)'),
+        make_option('--limit', type='int', dest='limit', default=None,
+            help='Stop after this many tombstones'),
+        make_option('--interval', type='int', dest='interval', default=None,
+            help='Keep running, draining every INTERVAL seconds'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = min(options['batch_size'], 1000)
+        while True:
+            result = S3Tombstone.drain(batch_size, options['limit'])
+            self.stdout.write('%s\n' % unicode(result))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
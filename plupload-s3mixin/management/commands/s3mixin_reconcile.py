@@ -0,0 +1,65 @@
+# Python imports
+from optparse import make_option
+
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from s3mixin.models import S3Mixin
+from s3mixin import reconcile
+
+class CommandReconciler(reconcile.Reconciler):
+    def __init__(self, command, **kwargs):
+        reconcile.Reconciler.__init__(self, **kwargs)
+        self.command = command
+
+    def on_orphan(self, entry):
+        self.command.stdout.write('orphan %s (%d bytes, %s)\n' % (entry.key.encode('utf-8'), entry.size, entry.last_modified))
+
+    def on_missing(self, key, rows):
+        self.command.stdout.write('missing %s (%s)\n' % (key, ', '.join(['%s %s' % (label, pk) for key, label, pk in rows])))
+
+    def on_batch(self, result):
+        self.command.stdout.write('reached %s, resume with --marker\n' % result.last_key)
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ('Lists the S3 objects no row of the S3Mixin models (all of them unless given) points at, '
+            'and the rows whose object is not on S3. Nothing is deleted without --delete')
+    option_list = BaseCommand.option_list + (
+        make_option('--delete', action='store_true', dest='delete', default=False,
+            help='Delete the orphan objects, needs --prefix'),
+        make_option('--prefix', dest='prefix', default='',
+            help='Only reconcile keys under this prefix'),
+        make_option('--exclude', action='append', dest='exclude', default=None,
+            help='A key which is never an orphan, repeatable (default: %s)' % ', '.join(reconcile.DEFAULT_EXCLUDE)),
+        make_option('--marker', dest='marker', default='',
+            help='Start after this key, as reported by an interrupted run'),
+        make_option('--min-age', type='int', dest='min_age', default=reconcile.DEFAULT_MIN_AGE,
+            help='Seconds an object must have been on S3 before it can be an orphan'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Orphans per S3 delete request (at most 1000)'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=reconcile.DEFAULT_CHUNK_SIZE,
+            help='Row keys sorted in memory at once'),
+    )
+
+    def handle(self, *args, **options):
+        models = []
+        for name in args:
+            model = get_model(*name.split('.', 1))
+            if model is None or not issubclass(model, S3Mixin):
+                raise CommandError('%s is not an S3Mixin model' % name)
+            models.append(model)
+        if models and options['delete']:
+            raise CommandError('--delete needs every S3Mixin model, the objects of the others would look like orphans')
+        if options['delete'] and not options['prefix']:
+            # the whole bucket may hold files of no S3Mixin row (crossdomain.xml, static files)
+            raise CommandError('--delete needs a --prefix holding only the files of S3Mixin rows')
+        exclude = options['exclude']
+        if exclude is None:
+            exclude = reconcile.DEFAULT_EXCLUDE
+        reconciler = CommandReconciler(self, models=models, prefix=options['prefix'], marker=options['marker'],
+                                       delete=options['delete'], min_age=options['min_age'], exclude=exclude,
+                                       batch_size=min(options['batch_size'], 1000), chunk_size=options['chunk_size'])
+        result = reconciler.run()
+        self.stdout.write('%s\n' % unicode(result))
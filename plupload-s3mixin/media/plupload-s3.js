@@ -13,6 +13,7 @@ var onPluploadFilesAdded = function(up, files) {
             up.removeFile(file);
         }
     });
+    fetchPluploadPolicies(up, files);
     if(up.settings.auto_upload) up.start();
     else
     {
@@ -20,7 +21,46 @@ var onPluploadFilesAdded = function(up, files) {
     }
 };
 
+// Signs all the files which are still queued in one request to batch_signature_url,
+// onPluploadUploadFile then uses the parameters stored on each file
+var fetchPluploadPolicies = function(up, files) {
+    if (!up.settings.batch_signature_url) return;
+    var queued = $.grep(files, function(file) { return up.getFile(file.id); });
+    if (!queued.length) return;
+    $.ajax({
+        url: up.settings.batch_signature_url,
+        dataType: 'json',
+        async: false,
+        traditional: true,
+        data: {
+            filename: $.map(queued, function(file) { return file.name; }),
+            file_size: $.map(queued, function(file) { return file.size; })
+        },
+        success: function(data) {
+            $.each(data.files, function(i, params) { queued[i].s3_params = params; });
+        }
+        // on error every file falls back to signature_url
+    });
+};
+
+var rejectPluploadFile = function(up, file, code, message) {
+    onPluploadError(up, {code: code, message: message, file: {name: file.name}});
+    $('#' + file.id).remove();
+    up.removeFile(file);
+    up.stop();
+    up.start();
+};
+
 var onPluploadUploadFile = function(up, file) {
+    // Policy Signature fetched along with the selection
+    if (file.s3_params) {
+        if (file.s3_params.errorMessage) {
+            rejectPluploadFile(up, file, 403, file.s3_params.errorMessage);
+            return false;
+        }
+        up.settings.multipart_params = file.s3_params;
+        return true;
+    }
     // Get Policy Signature for next file
     var ret = true;
     $.ajax({
@@ -31,23 +71,15 @@ var onPluploadUploadFile = function(up, file) {
         success: function(data) {
             if(data.errorMessage)
             {
-                onPluploadError(up, {code: 403, message: data.errorMessage, file: {name: file.name}});
                 ret =  false;
-                $('#' + file.id).remove();
-                up.removeFile(file);
-                up.stop();
-                up.start();
+                rejectPluploadFile(up, file, 403, data.errorMessage);
                 return;
             }
             up.settings.multipart_params = data;
         },
         error: function(jqXHR, textStatus, errorThrown) {
-                onPluploadError(up, {code: textStatus, message: errorThrown, file: {name: file.name}});
                 ret = false;
-                $('#' + file.id).remove();
-                up.removeFile(file);
-                up.stop();
-                up.start();
+                rejectPluploadFile(up, file, textStatus, errorThrown);
         }
     });
     return ret;
@@ -70,3 +102,241 @@ var onPluploadError = function(up, err) {
             "</div>"
             );
 };
+
+// Django's CSRF token, sent along with the POST requests of the multipart uploads
+var csrfToken = function() {
+    var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+    return match ? decodeURIComponent(match[1]) : '';
+};
+
+// Chunked mode: large files are sent straight from the browser to S3 as a multipart upload,
+// parts going in parallel to urls signed by the s3multipart view. Plupload keeps the selected
+// files to itself, so this mode reads them from its own file input with the HTML5 File API.
+var S3MultipartUpload = function(file, settings) {
+    this.file = file;
+    this.settings = settings;
+    this.storage_key = 's3multipart:' + settings.multipart_url + ':' + file.name + ':' + file.size + ':' + (file.lastModified || '');
+    this.failed = false;
+    this.completing = false;
+};
+
+S3MultipartUpload.prototype = {
+    start: function() {
+        var self = this, saved = self.load();
+        if (!saved) {
+            self.initiate();
+            return;
+        }
+        // an earlier upload of the same file was interrupted, only send the parts S3 does not have
+        self.call({action: 'list', key: saved.key, uploadId: saved.uploadId}, function(data) {
+            if (data.errorMessage) {
+                self.forget();
+                self.initiate();
+                return;
+            }
+            self.send(saved, data.parts);
+        }, function() {
+            self.forget();
+            self.initiate();
+        });
+    },
+
+    initiate: function() {
+        var self = this;
+        self.call({action: 'initiate', filename: self.file.name, file_size: self.file.size}, function(data) {
+            if (data.errorMessage) {
+                self.fail(403, data.errorMessage);
+                return;
+            }
+            self.send(data, []);
+        }, null, true);
+    },
+
+    send: function(upload, uploaded) {
+        var self = this, sizes = {}, i;
+        self.upload = upload;
+        self.save();
+        self.part_count = Math.max(1, Math.ceil(self.file.size / upload.partSize));
+        self.loaded = {};
+        self.pending = [];
+        self.active = 0;
+        $.each(uploaded, function(i, part) { sizes[part.partNumber] = part.size; });
+        for (i = 1; i <= self.part_count; i++) {
+            if (sizes[i] === self.part_end(i) - self.part_start(i)) self.loaded[i] = sizes[i];
+            else self.pending.push(i);
+        }
+        self.progress();
+        for (i = 0; i < self.settings.parallel_parts; i++) self.next();
+    },
+
+    part_start: function(part_number) {
+        return (part_number - 1) * this.upload.partSize;
+    },
+
+    part_end: function(part_number) {
+        return Math.min(part_number * this.upload.partSize, this.file.size);
+    },
+
+    next: function() {
+        if (this.failed) return;
+        if (!this.pending.length) {
+            if (!this.active) this.complete();
+            return;
+        }
+        this.active++;
+        this.send_part(this.pending.shift(), 0);
+    },
+
+    send_part: function(part_number, attempt) {
+        var self = this;
+        var retry = function() { self.retry(part_number, attempt); };
+        self.call({action: 'sign', key: self.upload.key, uploadId: self.upload.uploadId, partNumber: part_number}, function(data) {
+            if (data.errorMessage) {
+                self.fail(403, data.errorMessage);
+                return;
+            }
+            var xhr = new XMLHttpRequest();
+            xhr.open('PUT', data.urls[part_number], true);
+            xhr.upload.onprogress = function(e) {
+                self.loaded[part_number] = e.loaded;
+                self.progress();
+            };
+            xhr.onload = function() {
+                if (xhr.status != 200) {
+                    retry();
+                    return;
+                }
+                self.loaded[part_number] = self.part_end(part_number) - self.part_start(part_number);
+                self.progress();
+                self.active--;
+                self.next();
+            };
+            xhr.onerror = retry;
+            xhr.send(self.file.slice(self.part_start(part_number), self.part_end(part_number)));
+        }, retry);
+    },
+
+    retry: function(part_number, attempt) {
+        var self = this;
+        self.loaded[part_number] = 0;
+        if (self.failed) return;
+        if (attempt >= self.settings.part_retries) {
+            // the parts sent so far stay on S3, selecting the file again resumes the upload
+            self.fail(500, 'Could not upload ' + self.file.name + ', select it again to resume');
+            return;
+        }
+        setTimeout(function() { self.send_part(part_number, attempt + 1); }, 1000 * Math.pow(2, attempt));
+    },
+
+    complete: function() {
+        var self = this;
+        // every next() finding nothing left lands here, e.g. all of them when resuming an upload whose parts are all on S3
+        if (self.completing) return;
+        self.completing = true;
+        self.call({action: 'complete', key: self.upload.key, uploadId: self.upload.uploadId, parts: self.part_count}, function(data) {
+            if (self.failed) return;
+            if (data.errorMessage) {
+                self.fail(500, data.errorMessage);
+                return;
+            }
+            self.forget();
+            self.settings.on_uploaded(self, self.settings.aws_prefix + encodeURI(data.key));
+        }, null, true);
+    },
+
+    abort: function() {
+        this.failed = true;
+        if (this.upload) this.call({action: 'abort', key: this.upload.key, uploadId: this.upload.uploadId}, null, null, true);
+        this.forget();
+    },
+
+    progress: function() {
+        var total = 0;
+        $.each(this.loaded, function(part_number, loaded) { total += loaded; });
+        this.settings.on_progress(this, this.file.size ? Math.floor(100 * total / this.file.size) : 100);
+    },
+
+    fail: function(code, message) {
+        if (this.failed) return;
+        this.failed = true;
+        this.settings.on_error(this, code, message);
+    },
+
+    // initiate, complete and abort change the upload, the view only accepts them POSTed
+    call: function(data, success, error, post) {
+        var self = this;
+        if (post) data.csrfmiddlewaretoken = csrfToken();
+        $.ajax({
+            url: self.settings.multipart_url,
+            type: post ? 'POST' : 'GET',
+            dataType: 'json',
+            data: data,
+            success: success,
+            error: error || function(jqXHR, textStatus, errorThrown) { self.fail(textStatus, errorThrown); }
+        });
+    },
+
+    // the upload in progress is remembered so reloading the page and selecting the file again resumes it
+    load: function() {
+        try {
+            var saved = window.localStorage && localStorage.getItem(this.storage_key);
+            return saved ? $.parseJSON(saved) : null;
+        } catch (e) {
+            return null;
+        }
+    },
+
+    save: function() {
+        try {
+            if (window.localStorage) localStorage.setItem(this.storage_key, JSON.stringify(this.upload));
+        } catch (e) {}
+    },
+
+    forget: function() {
+        try {
+            if (window.localStorage) localStorage.removeItem(this.storage_key);
+        } catch (e) {}
+    }
+};
+
+var s3MultipartUploadId = 0;
+
+var bindS3MultipartInput = function(settings) {
+    // onPluploadError only reads the settings of the uploader
+    var up = {settings: settings};
+    var uploads = [];
+    settings.on_progress = function(upload, percent) {
+        $('#' + upload.id + ' b').html(percent + '%');
+    };
+    settings.on_uploaded = function(upload, file_url) {
+        $('#' + upload.id).remove();
+        settings.form.find('input[name=' + settings.file_input_name + ']').val(file_url);
+    };
+    settings.on_error = function(upload, code, message) {
+        onPluploadError(up, {code: code, message: message, file: {name: upload.file.name}});
+        $('#' + upload.id).remove();
+    };
+    var start = function() {
+        $.each(uploads, function(i, upload) { upload.start(); });
+        uploads = [];
+    };
+    settings.input.change(function() {
+        $('.upload-error').remove();
+        $.each(this.files, function(i, file) {
+            if (file.size > settings.max_file_size) {
+                var msg = file.name + ' size ' + plupload.formatSize(file.size) + ' is more than the limit (' + plupload.formatSize(settings.max_file_size) + ')';
+                onPluploadError(up, {code: 403, message: msg, file: {name: file.name}});
+                return;
+            }
+            var upload = new S3MultipartUpload(file, settings);
+            upload.id = settings.input.attr('id') + '-' + (++s3MultipartUploadId);
+            settings.filelistelement.append(
+                    '<div id="' + upload.id + '">' +
+                            file.name + ' (' + plupload.formatSize(file.size) + ') <b>Thinking...</b>' +
+                            '</div>');
+            uploads.push(upload);
+        });
+        if (settings.auto_upload) start();
+    });
+    if (!settings.auto_upload) settings.form.submit(function() { start(); return false; });
+};
@@ -1,22 +1,27 @@
 # Python imports
-import mimetypes
 import logging
 import time
 import base64
 import hmac, sha
 import os
-import zlib
 import rfc822
 import datetime
 import urllib
+import urllib2
+import threading
+import socket
+import httplib
+import tempfile
 
 # AppEngine imports
 from google.appengine.api import urlfetch
 
 # Django imports
 from django.utils import simplejson
-from django.db import models
-from django.shortcuts import render_to_response, get_object_or_404
+from django.db import models, IntegrityError
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.shortcuts import render_to_response
 from django import forms
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
@@ -28,8 +33,181 @@ from djangotoolbox.http import JSONResponse
 
 import S3
 import utils
+import tasks
+import filedata
+import cache
+import thumbnails
 
 SUPPORTED_FORMATS = 'jpg,png,gif,css,html,js,pdf,swf,ico,mp3'
+# uploads larger than this use S3 multipart upload (settings.AWS_MULTIPART_THRESHOLD)
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+
+# marks a 'file' value which is not known as loaded from the DB: a deferred field,
+# or an instance built with a pk rather than loaded (e.g. Model(pk=x, file=url))
+NOT_LOADED = object()
+
+# keys of content addressed objects, CAS_PREFIX + sha1 of the content + extension
+CAS_PREFIX = 'cas/'
+
+# tombstones whose delete failed are retried after 1, 2, 4... minutes, up to once a day
+TOMBSTONE_RETRY_DELAY = 60
+TOMBSTONE_MAX_RETRY_DELAY = 24 * 60 * 60
+
+_aws_connection = None
+_aws_connection_lock = threading.Lock()
+
+def get_aws_connection():
+    """
+        Returns the process wide S3 connection. It keeps a pool of keep-alive
+        connections, so it is shared by all S3Mixin instances and threads
+    """
+    global _aws_connection
+    if _aws_connection is None:
+        _aws_connection_lock.acquire()
+        try:
+            if _aws_connection is None:
+                pool = S3.ConnectionPool(
+                    getattr(settings, 'AWS_POOL_SIZE', S3.ConnectionPool.DEFAULT_MAX_SIZE),
+                    getattr(settings, 'AWS_POOL_IDLE_TIMEOUT', S3.ConnectionPool.DEFAULT_IDLE_TIMEOUT))
+                retry_policy = S3.RetryPolicy(
+                    max_attempts=getattr(settings, 'AWS_RETRY_ATTEMPTS', 3),
+                    attempt_timeout=getattr(settings, 'AWS_REQUEST_TIMEOUT', 60),
+                    deadline=getattr(settings, 'AWS_REQUEST_DEADLINE', None),
+                    hedge_after=getattr(settings, 'AWS_HEDGE_AFTER', None))
+                _aws_connection = S3.AWSAuthConnection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
+                                                       pool=pool, retry_policy=retry_policy)
+        finally:
+            _aws_connection_lock.release()
+    return _aws_connection
+
+def s3_key(file):
+    """
+        Returns the S3 key of a file url by deleting the AWS prefix of the url
+        e.g: http://9folds.s3.amazonaws.com/agpuaW5lOWZvbGRzchALEglQb3J0Zm9saW8YmAEM/1247867725.01/netanyahou.JPG
+    """
+    key = file[len(settings.AWS_PREFIX):]
+    return urllib.unquote(key.encode('UTF-8'))
+
+def is_content_addressed(key):
+    return key.startswith(CAS_PREFIX)
+
+def thumbnail_files(file, thumbs):
+    """ The urls (or keys) of the thumbnails of file pregenerated at thumbs ('WxH,WxH' as in S3Mixin.file_thumbs) """
+    if not file or not thumbs:
+        return []
+    return [utils.pregenerated_thumb(file, size) for size in thumbs.split(',')]
+
+def hash_data(data):
+    """
+        Returns (data, sha1 hex digest, size) for anything upload_data_to_s3 takes.
+        Streams are read once, hashing them while they are spooled (to disk past S3.SPOOL_MAX_SIZE),
+        and the spool is returned in their place, rewound.
+    """
+    digest = sha.new()
+    if isinstance(data, unicode):
+        data = data.encode('UTF-8')
+    if isinstance(data, str):
+        digest.update(data)
+        return data, digest.hexdigest(), len(data)
+    spool = tempfile.SpooledTemporaryFile(S3.SPOOL_MAX_SIZE)
+    for chunk in S3.iter_parts(data, S3.CHUNK_SIZE):
+        digest.update(chunk)
+        spool.write(chunk)
+    size = spool.tell()
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+_url_opener = urllib2.build_opener(NoRedirectHandler)
+
+def open_url(url):
+    """
+        Opens url for reading its body as a stream. Like download_to_server
+        redirects are not followed and any status but 200 raises urlfetch.Error
+    """
+    if isinstance(url, unicode):
+        url = url.encode('UTF-8')
+    try:
+        response = _url_opener.open(url, timeout=getattr(settings, 'AWS_REQUEST_TIMEOUT', 60))
+    except urllib2.HTTPError, e:
+        e.close()
+        logging.info('s3mixin received status_code %s' % e.code)
+        raise urlfetch.Error('HTTP status code %s' % e.code)
+    except urllib2.URLError, e:
+        raise urlfetch.Error('Could not fetch %s: %s' % (url, e.reason))
+    if response.getcode() != 200:
+        response.close()
+        logging.info('s3mixin received status_code %s' % response.getcode())
+        raise urlfetch.Error('HTTP status code %s' % response.getcode())
+    return response
+
+class CompressedTextDescriptor(object):
+    """ Holds the stored form of a CompressedTextField, decompressed on first access and again only if it changes """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.field.attname not in instance.__dict__:
+            # deferred, Django 1.10 and later leave it out of __dict__ until loaded
+            instance.refresh_from_db(fields=[self.field.attname])
+        stored = instance.__dict__[self.field.attname]
+        cache_name = self.field.get_cache_name()
+        cached = instance.__dict__.get(cache_name)
+        if cached is None or cached[0] is not stored:
+            cached = (stored, filedata.decode(stored))
+            instance.__dict__[cache_name] = cached
+        return cached[1]
+
+    def __set__(self, instance, value):
+        # loaded from the DB or assigned: plain text decodes to itself, unless it starts with filedata.MARKER
+        instance.__dict__[self.field.attname] = value
+
+class CompressedTextField(models.TextField):
+    """
+    A TextField stored in the format of filedata.py: large values are compressed when saved
+    and decompressed lazily on access. Lookups, values() and update() see the stored form,
+    which is plain text below filedata.MIN_SIZE.
+    """
+    def contribute_to_class(self, cls, name):
+        super(CompressedTextField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, CompressedTextDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        if self.attname not in model_instance.__dict__:
+            # deferred, loaded by getattr and compressed by get_db_prep_save
+            return super(CompressedTextField, self).pre_save(model_instance, add)
+        stored = model_instance.__dict__[self.attname]
+        if not filedata.is_encoded(stored):
+            # compressed once rather than at every save, the value stays cached
+            value = stored
+            stored = filedata.encode(value)
+            model_instance.__dict__[self.attname] = stored
+            model_instance.__dict__[self.get_cache_name()] = (stored, value)
+        return stored
+
+    def get_db_prep_save(self, value, connection):
+        # also compresses the values given to QuerySet.update()
+        if not filedata.is_encoded(value):
+            value = filedata.encode(value)
+        return super(CompressedTextField, self).get_db_prep_save(value, connection)
+
+class S3MixinQuerySet(QuerySet):
+    """ Marks the instances it loads, so S3Mixin.save() can trust their 'file' (before Django 1.8, see S3Mixin.from_db) """
+    def iterator(self):
+        for obj in super(S3MixinQuerySet, self).iterator():
+            if isinstance(obj, S3Mixin):
+                obj.mark_loaded()
+            yield obj
+
+class S3MixinManager(models.Manager):
+    def get_query_set(self):
+        return S3MixinQuerySet(self.model, using=self._db)
+    get_queryset = get_query_set
 
 class S3Mixin(models.Model):
     """A mixin class that gives thumbnail services for files uploaded to Amazon S3
@@ -37,13 +215,53 @@ class S3Mixin(models.Model):
     """
     file = models.URLField(null=True, blank=True, verify_exists=False, max_length=1000)
 #    file = models.CharField(null=True, max_length=300)
-    file_data = models.TextField(null=True, editable=False)
+    # compressed when large (see filedata.py)
+    file_data = CompressedTextField(null=True, editable=False)
+    # True while the file waits for background processing (deferred mode)
+    file_pending = models.BooleanField(default=False, editable=False)
+    # sizes ('WxH,WxH') of the thumbnails pregenerated for file, see THUMBNAIL_SIZES
+    file_thumbs = models.CharField(null=True, blank=True, editable=False, max_length=500)
 
     # Default types to be saved on the server side and not on S3
-    SERVER_TYPES = ('.html', '.htm', '.css')
+    SERVER_TYPES = utils.SERVER_TYPES
+    # Process files in the background through tasks.get_task_queue(). None follows settings.AWS_DEFERRED_PROCESSING
+    DEFERRED_PROCESSING = None
+    # Store uploads under keys derived from their content, sharing identical files. None follows settings.AWS_CONTENT_ADDRESSED
+    CONTENT_ADDRESSED = None
+    # Thumbnail sizes ('WxH' or (width, height), 0 leaves a dimension free) generated with PIL once
+    # an image is on S3, stored next to it as <key>.thumbs/<W>x<H><ext>. None follows settings.AWS_THUMBNAIL_SIZES
+    THUMBNAIL_SIZES = None
+
+    # marks the instances loaded from the DB. A model declaring its own managers should base them
+    # on S3MixinManager, or save() reads 'file' back from the DB before replacing it
+    objects = S3MixinManager()
+
     class Meta:
         abstract = True # important!
 
+    def __init__(self, *args, **kwargs):
+        super(S3Mixin, self).__init__(*args, **kwargs)
+        # Only an instance loaded from the DB (see mark_loaded) knows the 'file' of its row,
+        # any other with a pk has save() read it
+        if self.pk is None:
+            self._loaded_file = None
+        else:
+            self._loaded_file = NOT_LOADED
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Django 1.8 and later build every instance they load here
+        instance = super(S3Mixin, cls).from_db(db, field_names, values)
+        instance.mark_loaded()
+        return instance
+
+    def mark_loaded(self):
+        """
+            Remembers 'file' as loaded from the DB, so save() can tell whether it changed
+            without fetching the row again. A deferred 'file' (only()/defer()) is not loaded here
+        """
+        self._loaded_file = self.__dict__.get('file', NOT_LOADED)
+
     def download_to_server(self):
         """
             Downloads 'file' url to file_data
@@ -59,7 +277,7 @@ class S3Mixin(models.Model):
         self.file_data = fetch_result.content
 
     def get_aws_connection(self):
-        return S3.AWSAuthConnection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+        return get_aws_connection()
 
     def s3_prefix(self):
         """
@@ -68,34 +286,117 @@ class S3Mixin(models.Model):
         """
         return '%s/%s/' % (self.p.id, time.time())
 
-    def upload_data_to_s3(self, data, file_name, content_type=None):
+    def upload_data_to_s3(self, data, file_name, content_type=None, size=None):
         """
             Helper to upload_file_to_s3 + ....
+            data may be a string, a file-like object or an iterator of strings,
+            it is streamed to S3 in chunks rather than held in memory as a whole.
+            size is the number of bytes data holds, when it can not be told from data itself
+            (e.g. the Content-Length of a response being streamed)
+
+            In content addressed mode the key is derived from the sha1 of data, and the
+            upload is skipped when an object with that key already exists.
+            Raises IOError when S3 does not store the upload
         """
-        self.download_to_server()
-        s3_key = self.s3_prefix() + file_name
-        logging.info('uploading file_name %s s3_key %s' % (file_name, s3_key))
+        headers = self.upload_headers(file_name, content_type)
+        if not self.is_content_addressed():
+            s3_key = self.s3_prefix() + file_name
+            logging.info('uploading file_name %s s3_key %s' % (file_name, s3_key))
+            if not self.put_data_to_s3(s3_key, data, headers, size):
+                raise IOError('Could not upload %s to S3' % s3_key)
+            return self.s3name(s3_key)
+
+        hashed, digest, size = hash_data(data)
+        try:
+            s3_key = CAS_PREFIX + digest + os.path.splitext(file_name)[1].lower()
+            if S3Blob.exists(s3_key):
+                logging.info('file_name %s is already on S3 as %s' % (file_name, s3_key))
+            else:
+                logging.info('uploading file_name %s s3_key %s' % (file_name, s3_key))
+                if not self.put_data_to_s3(s3_key, hashed, headers, size):
+                    raise IOError('Could not upload %s to S3' % s3_key)
+                S3Blob.register(s3_key, size)
+        finally:
+            if hashed is not data and hasattr(hashed, 'close'):
+                hashed.close()
+        return self.s3name(s3_key)
+
+    def put_data_to_s3(self, s3_key, data, headers, size=None):
+        """ Uploads data to s3_key, returns whether S3 stored it """
+        connection = self.get_aws_connection()
+        # Large objects, or streams of unknown size, go up as a multipart upload
+        if size is None:
+            size = S3.data_length(data)
+        if size is None or size > getattr(settings, 'AWS_MULTIPART_THRESHOLD', MULTIPART_THRESHOLD):
+            response = connection.put_multipart(
+                settings.AWS_BUCKET,
+                s3_key,
+                S3.S3Object(data),
+                headers,
+                part_size=getattr(settings, 'AWS_MULTIPART_PART_SIZE', S3.DEFAULT_PART_SIZE),
+                workers=getattr(settings, 'AWS_MULTIPART_WORKERS', S3.DEFAULT_PART_WORKERS))
+            if response.http_response.status >= 300 or getattr(response, 'error_code', None):
+                logging.error('S3 multipart upload of %s failed: %s' % (s3_key, response.message))
+                return False
+        else:
+            headers = headers.copy()
+            headers['Content-Length'] = str(size)
+            response = connection.put(
+                settings.AWS_BUCKET,
+                s3_key,
+                S3.S3Object(data),
+                headers
+            )
+            if response.http_response.status >= 300:
+                logging.error('S3 upload of %s failed: %s' % (s3_key, response.message))
+                return False
+        return True
+
+    def upload_headers(self, file_name, content_type=None):
+        """ Headers of the S3 objects we create """
         if not content_type:
             if not file_name:
                 content_type = 'text/plain'
             else:
-                content_type = mimetypes.guess_type(file_name)[0]
+                content_type = utils.get_mime_info(file_name).mime_type
             # if mimetypes was unable to detect mime, use default
             if not content_type:
                 content_type = 'text/plain'
 
-        connection = self.get_aws_connection()
-        connection.put(
-            settings.AWS_BUCKET,
-            s3_key,
-            S3.S3Object(data),
-            {'x-amz-acl': 'public-read',
+        return {'x-amz-acl': 'public-read',
              'Content-Type': content_type,
              # Since we have the version prefix, this can stay cached in the browser forever
              'Cache-Control': 'public, max-age=2629743'
                 }
-        )
-        return self.s3name(s3_key)
+
+    def copy_file_on_s3(self, source_bucket, source_key):
+        """
+            Copies an object of another bucket (or key) to our bucket with a server side copy
+            and points 'file' at it, without the data going through this server.
+            Returns False if S3 would not copy it (e.g. no read access to the source bucket)
+        """
+        connection = self.get_aws_connection()
+        response = connection.head(source_bucket, source_key)
+        if response.http_response.status != 200:
+            logging.info('s3mixin can not copy %s/%s, HEAD status %s' % (source_bucket, source_key, response.http_response.status))
+            return False
+        size = int(response.http_response.getheader('content-length') or 0)
+        file_name = self.basename()
+        s3_key = self.s3_prefix() + file_name
+        headers = self.upload_headers(file_name, response.http_response.getheader('content-type'))
+        logging.info('copying %s/%s (%s bytes) to s3_key %s' % (source_bucket, source_key, size, s3_key))
+        if size > S3.MAX_COPY_SIZE:
+            response = connection.copy_multipart(source_bucket, source_key, settings.AWS_BUCKET, s3_key, size, headers,
+                workers=getattr(settings, 'AWS_MULTIPART_WORKERS', S3.DEFAULT_PART_WORKERS))
+        else:
+            response = connection.copy_object(source_bucket, source_key, settings.AWS_BUCKET, s3_key, headers, 'REPLACE')
+        if response.http_response.status >= 300 or getattr(response, 'error_code', None):
+            logging.warning('S3 copy of %s/%s failed: %s' % (source_bucket, source_key, response.message))
+            return False
+        self.file = self.s3name(s3_key)
+        logging.info('updated self.file to %s' % self.file)
+        self.file_data = None
+        return True
 
     def basename(self):
         return os.path.basename(self.file) if self.file else 'file'
@@ -118,15 +419,37 @@ class S3Mixin(models.Model):
         logging.info('updated self.file to %s' % self.file)
         self.file_data = None
 
+    def stream_file_to_s3(self):
+        """
+            Copies the remote 'file' url to S3 and points 'file' at the copy.
+            The body is fetched once and piped to S3 in chunks (multipart when large
+            or of unknown length), so it is never held in memory or in file_data
+        """
+        if not self.file:
+            return
+        logging.info('s3mixin streams %s to S3' % self.file)
+        response = open_url(self.file)
+        try:
+            length = response.info().getheader('Content-Length')
+            size = int(length) if length and length.strip().isdigit() else None
+            self.file = self.upload_data_to_s3(response, self.basename(), size=size)
+        finally:
+            response.close()
+        logging.info('updated self.file to %s' % self.file)
+        self.file_data = None
+
     def is_image(self):
         return self.extension().lower() in ('.jpg', '.png', '.gif', '.jpe')
 
     def size(self):
+        """ The (width, height) of the thumbnail of get_file_thumb(), for images the first of the thumbnail sizes if any """
+        sizes = self.get_thumbnail_sizes()
+        if sizes and self.is_image():
+            return tuple([int(dimension) for dimension in sizes[0].split('x')])
         return None,None
 
     def mime_type(self):
-        mime = mimetypes.guess_type(self.file)
-        return mime[0] if len(mime) else 'text/plain'
+        return utils.get_mime_info(self.file).mime_type
 
     def mime_icon(self):
         return media_url('images/txt.png')
@@ -147,93 +470,236 @@ class S3Mixin(models.Model):
         """
         if not self.file:
             return
-        ext = self.extension()
         # If this file type should be stored in the SERVER or a non S3 URL was given
-        if ext in self.SERVER_TYPES or not self.file.startswith(settings.AWS_PREFIX):
-            self.download_to_server()
-            if ext not in self.SERVER_TYPES:
-                self.upload_file_to_s3()
+        if self.needs_download():
+            if self.is_server_type():
+                self.download_to_server()
+            else:
+                # objects already on S3 are copied there, anything else is fetched
+                source = utils.parse_s3_url(self.file)
+                if source is None or not self.copy_file_on_s3(*source):
+                    self.stream_file_to_s3()
         else:
             self.file_data = None
 
-    def save(self, suppressFileDelete=False):
+    def needs_download(self):
+        """ Whether processing 'file' means fetching it (server side types and non S3 URLs) """
+        return bool(self.file) and (self.is_server_type() or not self.file.startswith(settings.AWS_PREFIX))
+
+    def is_server_type(self):
+        """ Whether 'file' is of the SERVER_TYPES, which are kept in file_data """
+        if self.SERVER_TYPES is utils.SERVER_TYPES:
+            return utils.get_mime_info(self.file).server_side
+        return self.extension().lower() in self.SERVER_TYPES
+
+    def is_deferred(self):
+        if self.DEFERRED_PROCESSING is None:
+            return getattr(settings, 'AWS_DEFERRED_PROCESSING', False)
+        return self.DEFERRED_PROCESSING
+
+    def is_content_addressed(self):
+        if self.CONTENT_ADDRESSED is None:
+            return getattr(settings, 'AWS_CONTENT_ADDRESSED', False)
+        return self.CONTENT_ADDRESSED
+
+    def get_thumbnail_sizes(self):
+        sizes = self.THUMBNAIL_SIZES
+        if sizes is None:
+            sizes = getattr(settings, 'AWS_THUMBNAIL_SIZES', ())
+        return [utils.format_thumb_size(size) for size in sizes]
+
+    def needs_thumbnails(self):
+        return bool(self.file) and self.file.startswith(settings.AWS_PREFIX) and self.is_image() \
+            and bool(self.get_thumbnail_sizes()) and thumbnails.available()
+
+    def pregenerate_thumbnails(self):
+        """
+            Uploads the thumbnails of 'file' at each of the thumbnail sizes, resized on thumbnails.get_pool().
+            Returns the sizes uploaded for file_thumbs. Raises IOError while the image is not on S3 (yet)
+        """
+        key = s3_key(self.file)
+        response = self.get_aws_connection().get(settings.AWS_BUCKET, key)
+        if response.http_response.status != 200:
+            raise IOError('Could not fetch %s to make thumbnails: %s' % (self.file, response.message))
+        sizes = self.get_thumbnail_sizes()
+        try:
+            resized = thumbnails.generate(response.object.data, sizes, self.extension())
+        except Exception, e:
+            # not worth retrying, e.g. a file PIL can not read
+            logging.exception(e)
+            return None
+        generated = []
+        for size, data in zip(sizes, resized):
+            thumb_key = utils.pregenerated_thumb(key, size)
+            if self.put_data_to_s3(thumb_key, data, self.upload_headers(thumb_key), len(data)):
+                generated.append(size)
+        logging.info('pregenerated thumbnails %s of %s' % (generated, self.file))
+        return ','.join(generated) or None
+
+    def reference_file(self, file):
+        """ Counts a reference to a content addressed file, which discard_file() releases """
+        if file and file.startswith(settings.AWS_PREFIX) and is_content_addressed(s3_key(file)):
+            S3Blob.acquire(s3_key(file))
+
+    def enqueue_task(self, func, *args):
+        tasks.enqueue_on_commit(func, self._meta.app_label, self._meta.object_name, *args)
+
+    def save(self, suppressFileDelete=False, *args, **kwargs):
         """ Helper services before save
+            'file' is compared with the value it was loaded with, not re-read from the DB.
+            Note that QuerySet.update() does not call save(), so files changed through it are not processed
         """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'file' not in update_fields:
+            # the file is not being written, leave it alone
+            super(S3Mixin, self).save(*args, **kwargs)
+            return
+
         if self.pk and not suppressFileDelete:
-            prev_entity = get_object_or_404(type(self), pk=self.pk)
-            prev_file = prev_entity.file
+            prev_file = self._loaded_file
+            if prev_file is NOT_LOADED:
+                if 'file' not in self.__dict__:
+                    # deferred and never touched, so it did not change
+                    super(S3Mixin, self).save(*args, **kwargs)
+                    return
+                else:
+                    # deferred then assigned, or not loaded at all: read what the row holds, if it exists
+                    rows = list(type(self)._default_manager.filter(pk=self.pk).values_list('file', flat=True)[:1])
+                    prev_file = rows and rows[0] or None
         else:
             prev_file = None
 
+        pending = False
+        prev_thumbs = self.file_thumbs
+        if self.file != prev_file:
+            deferred = self.is_deferred()
+            self.file_thumbs = None
+            if deferred and self.needs_download():
+                # save right away, a worker will fetch / upload the file
+                pending = True
+                self.file_data = None
+            else:
+                self.process_file()
+                self.reference_file(self.file)
+            self.file_pending = pending
+            if update_fields is not None:
+                # process_file() may have changed file_data as well
+                kwargs['update_fields'] = list(set(update_fields) | set(['file_data', 'file_pending', 'file_thumbs']))
+        super(S3Mixin, self).save(*args, **kwargs)
         if self.file != prev_file:
             if not suppressFileDelete:
-                # delete the previous file
-                self.delete_file(prev_file)
-            self.process_file()
-        super(S3Mixin, self).save()
+                # only once the row no longer points at it, a failed save keeps its file
+                self.discard_file(prev_file, prev_thumbs)
+            self.invalidate_render_cache(prev_file)
+        self._loaded_file = self.file
+        if pending:
+            self.enqueue_task(tasks.process_file_task, self.pk, self.file, prev_file)
+        elif self.file != prev_file and self.needs_thumbnails():
+            self.enqueue_task(tasks.pregenerate_thumbnails_task, self.pk, self.file, prev_file)
 
     def delete_files(self):
-        self.delete_file(self.file)
+        self.discard_file(self.file, self.file_thumbs)
         self.file = None
+        self.file_thumbs = None
+
+    def discard_file(self, file, thumbs=None):
+        """
+            Gets rid of a replaced or deleted file and its thumbnails (thumbs as in file_thumbs):
+            with settings.AWS_DELETE_TOMBSTONES it is left to S3Tombstone.drain(), in deferred
+            mode to a task, otherwise it is deleted now
+        """
+        if not file:
+            return
+        if file.startswith(settings.AWS_PREFIX) and is_content_addressed(s3_key(file)):
+            if not S3Blob.release(s3_key(file)):
+                # other rows still point at it, and at its thumbnails
+                return
+        for doomed in [file] + thumbnail_files(file, thumbs):
+            if getattr(settings, 'AWS_DELETE_TOMBSTONES', False):
+                S3Tombstone.bury(doomed)
+            elif self.is_deferred():
+                self.enqueue_task(tasks.delete_file_task, doomed)
+            else:
+                self.delete_file(doomed)
 
     def delete(self, **kwargs):
-        self.delete_files()
+        file, thumbs = self.file, self.file_thumbs
+        self.invalidate_render_cache(file)
         super(S3Mixin, self).delete(**kwargs)
+        # only once the row is gone, a failed delete keeps its file
+        self.discard_file(file, thumbs)
 
     def delete_file(self, file):
         """ Delete S3 object when entity is deleted
         """
         if not file:
-            return
-        # Delete the AWS prefix of the url
-        # e.g: http://9folds.s3.amazonaws.com/agpuaW5lOWZvbGRzchALEglQb3J0Zm9saW8YmAEM/1247867725.01/netanyahou.JPG
-        key = file[len(settings.AWS_PREFIX):]
-        key = urllib.unquote(key.encode('UTF-8'))
+            return True
+        key = s3_key(file)
+        if is_content_addressed(key) and not S3Blob.claim(key):
+            logging.info('Not deleting %s, it is referenced again' % file)
+            return True
         connection = self.get_aws_connection()
         response = connection.delete(settings.AWS_BUCKET, key)
         logging.info('Trying to delete %s. S3 response code %s ' % (file, response.http_response.status))
         if response.http_response.status != 204:
             msg = 'S3 could not delete object %s' % key
             logging.error(msg)
+            return False
+        return True
+
+    @classmethod
+    def delete_queryset_files(cls, queryset):
+        """ Delete the S3 objects of all the rows in queryset, up to 1000 per S3 request
+            The rows themselves are left untouched. Returns an S3.DeleteManyResult
+        """
+        rows = queryset.filter(file__startswith=settings.AWS_PREFIX).values_list('file', 'file_thumbs')
+        # shared content addressed objects (and their thumbnails) are only deleted along with their last reference
+        rows = ((file, thumbs) for file, thumbs in rows.iterator()
+                if not is_content_addressed(s3_key(file)) or (S3Blob.release(s3_key(file)) and S3Blob.claim(s3_key(file))))
+        keys = (s3_key(url) for file, thumbs in rows for url in [file] + thumbnail_files(file, thumbs))
+        result = get_aws_connection().delete_many(settings.AWS_BUCKET, keys)
+        logging.info('Deleted %s S3 objects, %s failed' % (len(result.deleted), len(result.errors)))
+        for error in result.errors:
+            logging.error('S3 could not delete object %s: %s %s' % (error.key, error.code, error.message))
+        return result
 
     def get_file(self):
-        file = self.file
-        if settings.AWS_CLOUDFRONT and file:
-            file = self.file.replace(settings.AWS_PREFIX, settings.AWS_CLOUDFRONT)
-            if settings.AWS_DNS_ROTATOR:
-                # Just to ease on crc32, let's trim the file name
-                i = zlib.crc32(file[len(settings.AWS_PREFIX):]) % settings.AWS_DNS_ROTATOR + 1
-                file = file.replace('http://', 'http://m%s.' % i)
-        return file
+        return utils.get_url_rewriter().cdn_url(self.file)
 
     def get_file_thumb(self):
-        url = self.file
         w, h = self.size()
-        if (w or h) and url:
-            url = url.replace(settings.AWS_PREFIX, '%s%sx%s/' % (settings.THUMBNAIL_SERVICE, w or 0,h or 0))
-            if not settings.ON_PRODUCTION_SERVER:
-                url = '%s?domain=%s' % (url, settings.AWS_PREFIX[7:-1])
-            if setings.AWS_DNS_ROTATOR:
-                # Just to ease on crc32, let's trim the file name
-                i = zlib.crc32(url[len(settings.AWS_PREFIX):]) % ( settings.AWS_DNS_ROTATOR + 1)
-                url = url.replace('http://', 'http://m%s.' % i)
-            return url
+        if (w or h) and self.file:
+            return utils.get_url_rewriter().thumb_url(self.file, (w, h), self.file_thumbs)
         else:
             return self.get_file()
 
+    def cached_render(self, mode, render):
+        """ Returns render(), memoized by (file, name, mode, size) in cache.get_render_cache() """
+        render_cache = cache.get_render_cache()
+        if render_cache is None:
+            return render()
+        return render_cache.get_or_render(self.file, (self.name, mode, self.size()), render)
+
+    def invalidate_render_cache(self, file):
+        render_cache = cache.get_render_cache()
+        if render_cache is not None:
+            render_cache.invalidate(file)
+
     def render(self):
         try:
-            file = self.get_file()
-            params = {'file': file, 'name': self.name}
-            return utils.get_render_string_by_extension(file, params, False)
+            return self.cached_render('render', self._render)
         except Exception,e:
             logging.exception(e)
 
+    def _render(self):
+        file = self.get_file()
+        params = {'file': file, 'name': self.name}
+        return utils.get_render_string_by_extension(file, params, False)
+
     def render_visible(self):
         try:
-            file = self.get_file()
-            if file:
-                return utils.get_render_string_by_extension(file, {'file':file, 'name': self.name}, True)
+            if self.file:
+                return self.cached_render('visible', self._render_visible)
             elif self.file_data:
                 return mark_safe(self.file_data)
             else:
@@ -241,12 +707,164 @@ class S3Mixin(models.Model):
         except Exception,e:
             logging.exception(e)
 
+    def _render_visible(self):
+        file = self.get_file()
+        return utils.get_render_string_by_extension(file, {'file':file, 'name': self.name}, True)
+
     def render_thumb(self):
         try:
-            file = self.get_file_thumb()
-            if file:
-                return utils.get_render_string_by_extension(file, {'file': file, 'name':self.name}, True)
+            if self.file:
+                return self.cached_render('thumb', self._render_thumb)
             else:
                 return 'No Thumbnail'
         except Exception,e:
-            logging.exception(e)
\ No newline at end of file
+            logging.exception(e)
+
+    def _render_thumb(self):
+        file = self.get_file_thumb()
+        return utils.get_render_string_by_extension(file, {'file': file, 'name':self.name}, True)
+
+class DrainResult:
+    def __init__(self):
+        self.deleted = 0
+        self.failed = 0
+        self.batches = 0
+        self.elapsed = 0
+
+    def __unicode__(self):
+        return u'%d S3 objects deleted, %d failed, in %d batches and %.2fs' % (
+            self.deleted, self.failed, self.batches, self.elapsed)
+
+class S3Tombstone(models.Model):
+    """
+    An S3 object waiting to be deleted. With settings.AWS_DELETE_TOMBSTONES S3Mixin
+    records the keys of replaced and deleted files here, instead of deleting them from
+    S3 during the request. They are recorded once the row is written, so a failed save
+    or delete buries nothing; should recording fail then, the object is left for
+    s3mixin_reconcile to find.
+    S3Tombstone.drain() (the s3mixin_drain_tombstones command, run from cron) deletes
+    them up to 1000 per S3 request. Failed deletes stay and are retried with backoff.
+    """
+    key = models.CharField(max_length=1000)
+    created = models.DateTimeField(auto_now_add=True)
+    retry_after = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(null=True, blank=True, max_length=500)
+
+    def __unicode__(self):
+        return self.key
+
+    @classmethod
+    def bury(cls, file):
+        """ Records the S3 object of a file url for deletion. Urls outside of AWS_PREFIX are ignored """
+        if not file or not file.startswith(settings.AWS_PREFIX):
+            return None
+        return cls.objects.create(key=s3_key(file))
+
+    @classmethod
+    def drain(cls, batch_size=S3.MAX_DELETE_KEYS, limit=None):
+        """
+            Deletes the S3 objects of due tombstones in batches of batch_size keys,
+            at most limit tombstones when given. Returns a DrainResult
+        """
+        result = DrainResult()
+        start = time.time()
+        connection = get_aws_connection()
+        now = datetime.datetime.now()
+        while limit is None or result.deleted + result.failed < limit:
+            size = batch_size if limit is None else min(batch_size, limit - result.deleted - result.failed)
+            batch = list(cls.objects.filter(retry_after__lte=now).order_by('retry_after')[:size])
+            if not batch:
+                break
+            result.batches += 1
+            keys = dict((tombstone.key, None) for tombstone in batch)
+            # content addressed objects referenced again since they were buried are kept
+            doomed = [key for key in keys if not is_content_addressed(key) or S3Blob.claim(key)]
+            try:
+                errors = connection.delete_many(settings.AWS_BUCKET, doomed).errors
+                for error in errors:
+                    keys[error.key] = '%s %s' % (error.code, error.message)
+            except (socket.error, httplib.HTTPException), e:
+                logging.exception(e)
+                for key in keys:
+                    keys[key] = str(e)
+            deleted = [tombstone.pk for tombstone in batch if keys[tombstone.key] is None]
+            if deleted:
+                cls.objects.filter(pk__in=deleted).delete()
+            for tombstone in batch:
+                if keys[tombstone.key] is not None:
+                    tombstone.failed(keys[tombstone.key], now)
+            result.deleted += len(deleted)
+            result.failed += len(batch) - len(deleted)
+        result.elapsed = time.time() - start
+        logging.info('s3mixin tombstones: %s' % unicode(result))
+        return result
+
+    def failed(self, error, now):
+        logging.error('S3 could not delete object %s: %s' % (self.key, error))
+        delay = min(TOMBSTONE_RETRY_DELAY * 2 ** self.attempts, TOMBSTONE_MAX_RETRY_DELAY)
+        self.attempts += 1
+        self.retry_after = now + datetime.timedelta(seconds=delay)
+        self.last_error = error[:500]
+        self.save()
+
+class S3Blob(models.Model):
+    """
+    The index of content addressed objects (see S3Mixin.CONTENT_ADDRESSED), counting
+    the rows pointing at each so a shared object is only deleted with the last of them.
+    Objects are found on S3 by HEAD when missing from the index (e.g. uploaded before it existed).
+    Only rows with a size were seen on S3; a reference to an object which was not (size None)
+    is counted, but exists() still asks S3 about it.
+
+    There is a short window where an object being deleted with its last reference is
+    found by HEAD and reused, leaving the new row pointing at a deleted object.
+    """
+    key = models.CharField(primary_key=True, max_length=200)
+    size = models.BigIntegerField(null=True)
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.key
+
+    @classmethod
+    def exists(cls, key):
+        """ Whether the object is on S3, as told by the index or else a HEAD request """
+        if cls.objects.filter(pk=key, size__isnull=False).exists():
+            return True
+        response = get_aws_connection().head(settings.AWS_BUCKET, key)
+        if response.http_response.status != 200:
+            return False
+        cls.register(key, int(response.http_response.getheader('content-length') or 0))
+        return True
+
+    @classmethod
+    def register(cls, key, size):
+        """ Adds an object which was just uploaded to the index, with no references yet """
+        try:
+            cls.objects.create(key=key, size=size)
+        except IntegrityError:
+            # registered by a concurrent upload of the same content, or referenced before it was seen on S3
+            cls.objects.filter(pk=key, size__isnull=True).update(size=size)
+
+    @classmethod
+    def acquire(cls, key):
+        """ Counts a reference, a key which is not registered yet is not taken to be on S3 (size None) """
+        if cls.objects.filter(pk=key).update(refcount=F('refcount') + 1):
+            return
+        try:
+            cls.objects.create(key=key, size=None, refcount=1)
+        except IntegrityError:
+            cls.objects.filter(pk=key).update(refcount=F('refcount') + 1)
+
+    @classmethod
+    def release(cls, key):
+        """ Drops a reference, returns True when none is left and the object may be deleted """
+        cls.objects.filter(pk=key, refcount__gt=0).update(refcount=F('refcount') - 1)
+        return not cls.objects.filter(pk=key, refcount__gt=0).exists()
+
+    @classmethod
+    def claim(cls, key):
+        """ Removes an unreferenced object from the index right before deleting it, returns False if it is referenced """
+        cls.objects.filter(pk=key, refcount__lte=0).delete()
+        return not cls.objects.filter(pk=key).exists()
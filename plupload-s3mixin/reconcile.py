@@ -0,0 +1,229 @@
+# Python imports
+import calendar
+import heapq
+import logging
+import marshal
+import tempfile
+import time
+
+# Django imports
+from django.conf import settings
+from django.db.models import get_models
+
+import S3
+from s3mixin.models import S3Mixin, S3Tombstone, S3Blob, get_aws_connection, s3_key, is_content_addressed, thumbnail_files
+
+# keys sorted in memory at once before being spilled to a temporary file
+DEFAULT_CHUNK_SIZE = 100000
+# objects younger than this are never orphans: their row may not be saved yet
+DEFAULT_MIN_AGE = 24 * 60 * 60
+# at least this many listed objects between two progress reports
+CHECKPOINT_OBJECTS = 10000
+# keys which are never orphans, e.g. the crossdomain.xml Flash reads from the bucket (see the readme)
+DEFAULT_EXCLUDE = ('crossdomain.xml',)
+
+def s3mixin_models():
+    return [model for model in get_models() if issubclass(model, S3Mixin)]
+
+def last_modified_time(entry):
+    """ Seconds since the epoch of a BucketEntry's LastModified (e.g. 2009-10-12T17:50:30.000Z) """
+    return calendar.timegm(time.strptime(entry.last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def iter_file_keys(models, prefix='', batch_size=1000):
+    """
+        Yields (S3 key, 'app_label.ModelName', pk) for the file of every row of models which is on S3,
+        and for each of its pregenerated thumbnails, in no particular order
+    """
+    for model in models:
+        label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        queryset = model._default_manager.filter(file__startswith=settings.AWS_PREFIX + prefix).order_by('pk')
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', 'file', 'file_thumbs')[:batch_size])
+            if not batch:
+                break
+            for pk, file, thumbs in batch:
+                yield s3_key(file), label, pk
+                for thumb in thumbnail_files(file, thumbs):
+                    yield s3_key(thumb), label, pk
+            last_pk = batch[-1][0]
+
+def _spill(rows):
+    rows.sort()
+    spill = tempfile.TemporaryFile()
+    for row in rows:
+        marshal.dump(row, spill)
+    spill.seek(0)
+    return spill
+
+def _read_spill(spill):
+    try:
+        while True:
+            yield marshal.load(spill)
+    except EOFError:
+        spill.close()
+
+def sorted_file_keys(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Yields rows (as from iter_file_keys) sorted by key with at most chunk_size of them in memory.
+        The DB can not sort them itself: 'file' holds urls, quoted or not, which sort differently
+        than the keys, and its collation is not the byte order of the S3 listing.
+        Sorted chunks are spilled to temporary files and merged back.
+    """
+    spills = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            spills.append(_spill(chunk))
+            chunk = []
+    if not spills:
+        chunk.sort()
+        return iter(chunk)
+    if chunk:
+        spills.append(_spill(chunk))
+    return heapq.merge(*[_read_spill(spill) for spill in spills])
+
+def merge_diff(entries, rows):
+    """
+        Walks the bucket listing (BucketEntry objects) and sorted rows together.
+        Yields (key, entry, rows): entry is None for a key missing from S3, rows is empty for an object no row references
+    """
+    entries = iter(entries)
+    rows = iter(rows)
+    entry = next(entries, None)
+    row = next(rows, None)
+    while entry is not None or row is not None:
+        entry_key = entry is not None and entry.key.encode('utf-8') or None
+        if row is None or (entry is not None and entry_key < row[0]):
+            yield entry_key, entry, []
+            entry = next(entries, None)
+            continue
+        key = row[0]
+        matched = []
+        while row is not None and row[0] == key:
+            matched.append(row)
+            row = next(rows, None)
+        if entry_key == key:
+            yield key, entry, matched
+            entry = next(entries, None)
+        else:
+            yield key, None, matched
+
+class ReconcileResult:
+    def __init__(self):
+        self.objects = 0
+        self.orphans = 0
+        self.deleted = 0
+        self.failed = 0
+        self.missing = 0
+        self.kept = 0
+        self.recent = 0
+        self.last_key = ''
+        self.elapsed = 0
+
+    def __unicode__(self):
+        return u'%d S3 objects, %d orphans (%d deleted, %d failed, %d kept), %d too recent, %d rows missing their object, in %.2fs' % (
+            self.objects, self.orphans, self.deleted, self.failed, self.kept, self.recent, self.missing, self.elapsed)
+
+class Reconciler:
+    """
+    Finds S3 objects no S3Mixin row points at (orphans), e.g. uploads whose row was
+    dropped or whose delete failed, and rows pointing at objects which are not on S3,
+    e.g. a signed upload which never happened.
+
+    The bucket listing is streamed page by page and the keys of the rows are sorted
+    out of memory, so neither side is held in memory as a whole. Orphans are
+    reported to on_orphan(entry) and, with delete=True, deleted up to 1000 per request;
+    rows missing their object are reported to on_missing(key, rows).
+
+    Objects younger than min_age seconds, listed in exclude, already buried in S3Tombstone
+    or content addressed and referenced again (see S3Blob) are kept.
+    Everything else under prefix is expected to belong to S3Mixin rows: keep other files
+    out of it. A run stopped halfway is resumed from the key it reached (marker).
+    """
+    def __init__(self, models=None, prefix='', marker='', delete=False, min_age=DEFAULT_MIN_AGE,
+                 batch_size=S3.MAX_DELETE_KEYS, chunk_size=DEFAULT_CHUNK_SIZE, connection=None,
+                 exclude=DEFAULT_EXCLUDE):
+        self.models = models or s3mixin_models()
+        self.prefix = prefix
+        self.exclude = frozenset(exclude)
+        self.marker = marker
+        self.delete = delete
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.connection = connection or get_aws_connection()
+
+    def on_orphan(self, entry):
+        pass
+
+    def on_missing(self, key, rows):
+        pass
+
+    def on_batch(self, result):
+        """ Called after each batch of orphans and every CHECKPOINT_OBJECTS objects, result.last_key is a safe marker to resume from """
+        pass
+
+    def run(self):
+        result = ReconcileResult()
+        start = time.time()
+        now = time.time()
+        entries = self.connection.iter_bucket(settings.AWS_BUCKET, self.prefix, marker=self.marker)
+        rows = sorted_file_keys(iter_file_keys(self.models, self.prefix), self.chunk_size)
+        if self.marker:
+            rows = (row for row in rows if row[0] > self.marker)
+        orphans = []
+        checkpoint = CHECKPOINT_OBJECTS
+        for key, entry, matched in merge_diff(entries, rows):
+            if entry is None:
+                result.missing += 1
+                self.on_missing(key, matched)
+                continue
+            result.objects += 1
+            if not matched:
+                if key in self.exclude:
+                    result.kept += 1
+                elif now - last_modified_time(entry) < self.min_age:
+                    result.recent += 1
+                else:
+                    orphans.append(entry)
+            if len(orphans) >= self.batch_size or result.objects >= checkpoint:
+                checkpoint = result.objects + CHECKPOINT_OBJECTS
+                self.flush(orphans, result)
+                orphans = []
+                # every key before this one is settled
+                result.last_key = key
+                self.on_batch(result)
+        self.flush(orphans, result)
+        result.elapsed = time.time() - start
+        logging.info('s3mixin reconcile: %s' % unicode(result))
+        return result
+
+    def flush(self, orphans, result):
+        if not orphans:
+            return
+        result.orphans += len(orphans)
+        keys = [entry.key for entry in orphans]
+        buried = set(S3Tombstone.objects.filter(key__in=keys).values_list('key', flat=True))
+        doomed = []
+        for entry in orphans:
+            if entry.key in buried or (is_content_addressed(entry.key) and self.is_referenced(entry.key)):
+                # S3Tombstone.drain() deletes it, or a row is about to reference it
+                result.kept += 1
+                continue
+            self.on_orphan(entry)
+            doomed.append(entry.key)
+        if not self.delete or not doomed:
+            return
+        errors = self.connection.delete_many(settings.AWS_BUCKET, doomed).errors
+        for error in errors:
+            logging.error('S3 could not delete object %s: %s %s' % (error.key, error.code, error.message))
+        result.deleted += len(doomed) - len(errors)
+        result.failed += len(errors)
+
+    def is_referenced(self, key):
+        if self.delete:
+            return not S3Blob.claim(key)
+        return S3Blob.objects.filter(pk=key, refcount__gt=0).exists()
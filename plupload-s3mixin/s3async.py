@@ -0,0 +1,132 @@
+# Python imports
+import collections
+import httplib
+from StringIO import StringIO
+
+# AppEngine imports
+from google.appengine.api import urlfetch
+
+import S3
+from s3mixin.models import get_aws_connection
+
+# S3 answers 307 when a bucket is being moved between regions, follow that many at most
+MAX_REDIRECTS = 5
+DEFAULT_MAX_IN_FLIGHT = 50
+DEFAULT_DEADLINE = 30
+
+class UrlfetchResponse:
+    """
+    Presents a urlfetch result like an httplib.HTTPResponse, so the S3 response
+    classes (Response, GetResponse, ListBucketResponse...) parse it unchanged
+    """
+    def __init__(self, result):
+        self.status = result.status_code
+        self.reason = httplib.responses.get(result.status_code, '')
+        self.msg = result.headers
+        self._body = StringIO(result.content or '')
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def close(self):
+        pass
+
+class S3RPC:
+    """
+    A pending S3 request. get_result() waits for it and returns the same Response
+    object the blocking AWSAuthConnection method would have returned
+    """
+    def __init__(self, client, response_class, method, bucket, key, query_args, headers, data):
+        self.client = client
+        self.response_class = response_class
+        self.request = (method, bucket, key, query_args, headers, data)
+        self.rpc = None
+        self._response = None
+
+    def get_result(self):
+        if self._response is None:
+            result = self.rpc.get_result()
+            redirects = 0
+            while 300 <= result.status_code < 400 and result.headers.get('location') and redirects < MAX_REDIRECTS:
+                # redirects are rare, they are followed synchronously
+                redirects += 1
+                rpc = self.client._fetch(self.request, result.headers['location'])
+                result = rpc.get_result()
+            self._response = self.response_class(UrlfetchResponse(result))
+        return self._response
+
+    def wait(self):
+        self.rpc.wait()
+
+class AsyncAWSAuthConnection:
+    """
+    Non blocking S3 client for AppEngine, built on asynchronous urlfetch calls.
+    It mirrors put / get / delete / copy_object / list_bucket of S3.AWSAuthConnection
+    but returns an S3RPC right away; call get_result() on it for the usual Response.
+    Requests are addressed and signed by an S3.AWSAuthConnection (the shared one by default).
+
+    At most max_in_flight requests run at once: starting one more first waits for
+    the oldest. urlfetch keeps its own pool of connections to S3.
+
+        client = AsyncAWSAuthConnection()
+        rpcs = [client.delete(settings.AWS_BUCKET, key) for key in keys]
+        statuses = [rpc.get_result().http_response.status for rpc in rpcs]
+    """
+    def __init__(self, connection=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, deadline=DEFAULT_DEADLINE):
+        self.connection = connection or get_aws_connection()
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self._in_flight = collections.deque()
+
+    def put(self, bucket, key, object, headers={}):
+        if not isinstance(object, S3.S3Object):
+            object = S3.S3Object(object)
+        data = object.data
+        if hasattr(data, 'read'):
+            # urlfetch takes the payload as a single string
+            data = data.read()
+        return self._start(S3.Response, 'PUT', bucket, key, {}, S3.merge_meta(headers, object.metadata), data)
+
+    def get(self, bucket, key, headers={}):
+        return self._start(S3.GetResponse, 'GET', bucket, key, {}, headers)
+
+    def delete(self, bucket, key, headers={}):
+        return self._start(S3.Response, 'DELETE', bucket, key, {}, headers)
+
+    def copy_object(self, source_bucket, source_key, destination_bucket, destination_key, headers={}, metadata_directive=None):
+        headers = S3.copy_object_headers(source_bucket, source_key, destination_bucket, destination_key, headers, metadata_directive)
+        return self._start(S3.CopyObjectResponse, 'PUT', destination_bucket, destination_key, {}, headers)
+
+    def list_bucket(self, bucket, options={}, headers={}):
+        return self._start(S3.ListBucketResponse, 'GET', bucket, '', options, headers)
+
+    def wait_all(self):
+        """ Waits for every request started so far """
+        while self._in_flight:
+            self._in_flight.popleft().wait()
+
+    def _start(self, response_class, method, bucket, key, query_args, headers, data=None):
+        while len(self._in_flight) >= self.max_in_flight:
+            self._in_flight.popleft().wait()
+        s3rpc = S3RPC(self, response_class, method, bucket, key, query_args, headers, data)
+        s3rpc.rpc = self._fetch(s3rpc.request)
+        self._in_flight.append(s3rpc.rpc)
+        return s3rpc
+
+    def _fetch(self, request, url=None):
+        method, bucket, key, query_args, headers, data = request
+        if url is None:
+            server, path = self.connection.request_target(bucket, key, query_args)
+            url = '%s://%s:%d%s' % (self.connection.is_secure and 'https' or 'http', server, self.connection.port, path)
+        headers = self.connection.signed_headers(method, bucket, key, query_args, headers)
+        rpc = urlfetch.create_rpc(deadline=self.deadline)
+        urlfetch.make_fetch_call(rpc, url, payload=data, method=method, headers=headers, follow_redirects=False)
+        return rpc
@@ -0,0 +1,162 @@
+# Python imports
+import logging
+import threading
+
+# Django imports
+from django.conf import settings
+from django.db import transaction
+from django.db.models import get_model
+from django.utils.importlib import import_module
+
+import S3
+import utils
+
+class TaskQueue:
+    """
+    Runs tasks outside of the request. Backends implement enqueue(func, *args),
+    func being a module level function (so it can be pickled) which raises to be retried.
+    Tasks must be idempotent: a retried or duplicated task has to be harmless.
+    """
+    def enqueue(self, func, *args):
+        raise NotImplementedError
+
+class InlineTaskQueue(TaskQueue):
+    """ Runs tasks right away, in the calling thread """
+    def enqueue(self, func, *args):
+        func(*args)
+
+class ThreadPoolTaskQueue(TaskQueue):
+    """
+    In-process backend for local use: tasks run on a pool of daemon threads and are
+    retried up to max_retries times with exponential backoff. Pending tasks are lost
+    when the process exits.
+    """
+    MAX_PENDING = 10000
+
+    def __init__(self, workers=4, max_retries=3, retry_delay=1):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._pool = S3.WorkerPool(workers, self.MAX_PENDING)
+
+    def enqueue(self, func, *args):
+        self._pool.submit(self._run, func, args, 0)
+
+    def _run(self, func, args, attempt):
+        try:
+            func(*args)
+        except Exception, e:
+            if attempt >= self.max_retries:
+                logging.exception('s3mixin task %s%r failed, giving up' % (func.__name__, args))
+                return
+            logging.warning('s3mixin task %s%r failed (%s), retrying' % (func.__name__, args, e))
+            timer = threading.Timer(self.retry_delay * 2 ** attempt, self._pool.submit, (self._run, func, args, attempt + 1))
+            timer.setDaemon(True)
+            timer.start()
+
+class AppEngineTaskQueue(TaskQueue):
+    """ Runs tasks on the AppEngine task queue (settings.AWS_TASK_QUEUE_NAME), which retries failed tasks """
+    def enqueue(self, func, *args):
+        from google.appengine.ext import deferred
+        deferred.defer(func, *args, _queue=getattr(settings, 'AWS_TASK_QUEUE_NAME', 'default'))
+
+_task_queue = None
+_task_queue_lock = threading.Lock()
+
+def get_task_queue():
+    """ Returns the process wide task queue, an instance of settings.AWS_TASK_QUEUE """
+    global _task_queue
+    if _task_queue is None:
+        _task_queue_lock.acquire()
+        try:
+            if _task_queue is None:
+                path = getattr(settings, 'AWS_TASK_QUEUE', 's3mixin.tasks.ThreadPoolTaskQueue')
+                module, name = path.rsplit('.', 1)
+                _task_queue = getattr(import_module(module), name)()
+        finally:
+            _task_queue_lock.release()
+    return _task_queue
+
+def enqueue_on_commit(func, *args):
+    """
+        Enqueues a task once the current transaction commits, so workers see the saved row.
+        Django versions without transaction.on_commit (before 1.9) can not wait for the commit:
+        the task is enqueued right away and has to raise until it sees the save (see get_saved_row)
+    """
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        get_task_queue().enqueue(func, *args)
+    else:
+        on_commit(lambda: get_task_queue().enqueue(func, *args))
+
+class NotCommitted(Exception):
+    """ Raised by a task which does not see the save that enqueued it yet, so it is retried """
+
+def get_saved_row(model, pk, file, previous):
+    """
+        Returns the row saved with file, which had previous before, or None if it was deleted
+        or moved past file since. Without transaction.on_commit the task may run before the
+        save commits: a missing row, or one still at previous, raises NotCommitted then.
+        A row deleted meanwhile is retried until the queue gives up on it.
+    """
+    waits_for_commit = getattr(transaction, 'on_commit', None) is not None
+    try:
+        instance = model._default_manager.get(pk=pk)
+    except model.DoesNotExist:
+        if waits_for_commit:
+            return None
+        raise NotCommitted('%s %s is not saved yet' % (model.__name__, pk))
+    if instance.file != file:
+        if not waits_for_commit and instance.file == previous:
+            raise NotCommitted('%s %s is not saved with %s yet' % (model.__name__, pk, file))
+        return None
+    return instance
+
+# Tasks
+
+def process_file_task(app_label, model_name, pk, file, previous=None):
+    """
+        Downloads / uploads the file of a row saved in deferred mode, previous being its file before.
+        Does nothing if the row is gone, already processed or got another file meanwhile.
+    """
+    model = get_model(app_label, model_name)
+    instance = get_saved_row(model, pk, file, previous)
+    if instance is None or not instance.file_pending:
+        return
+    instance.process_file()
+    if instance.file != file:
+        instance.reference_file(instance.file)
+    # only write the result if the file is still the one we processed
+    updated = model._default_manager.filter(pk=pk, file=file, file_pending=True).update(
+        file=instance.file, file_data=instance.file_data, file_pending=False)
+    if not updated and instance.file != file:
+        # the row moved on while we uploaded, the new object belongs to nobody
+        instance.discard_file(instance.file)
+    elif updated and instance.needs_thumbnails():
+        # the row is already at instance.file, there is no earlier save to wait for
+        instance.enqueue_task(pregenerate_thumbnails_task, pk, instance.file, instance.file)
+
+def pregenerate_thumbnails_task(app_label, model_name, pk, file, previous=None):
+    """
+        Uploads the thumbnails of a row's image, previous being the row's file before it was saved
+        with this one. Raises (to be retried) while the image is not on S3 yet, e.g. a row saved
+        before the browser uploaded its file.
+        Does nothing if the row is gone or got another file meanwhile.
+    """
+    model = get_model(app_label, model_name)
+    instance = get_saved_row(model, pk, file, previous)
+    if instance is None or instance.file_pending or not instance.needs_thumbnails():
+        return
+    thumbs = instance.pregenerate_thumbnails()
+    if model._default_manager.filter(pk=pk, file=file).update(file_thumbs=thumbs):
+        # renders of the file point at the thumbnail service until now
+        instance.invalidate_render_cache(file)
+    elif thumbs and not instance.is_content_addressed():
+        # the row moved on, the thumbnails belong to nobody (content addressed ones are shared)
+        for size in thumbs.split(','):
+            instance.discard_file(utils.pregenerated_thumb(file, size))
+
+def delete_file_task(app_label, model_name, file):
+    """ Deletes an S3 object, deleting it twice is harmless """
+    model = get_model(app_label, model_name)
+    if not model().delete_file(file):
+        raise IOError('S3 could not delete %s' % file)
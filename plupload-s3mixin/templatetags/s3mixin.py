@@ -1,7 +1,4 @@
-import zlib
-
 from django import template
-from django.conf import settings
 from .. import utils
 register = template.Library()
 
@@ -9,15 +6,7 @@ register = template.Library()
 def thumb(file, args ):
     if not file:
         return ''
-    url = file.file
-    url = url.replace(settings.AWS_PREFIX, '%s%s/' % (settings.THUMBNAIL_SERVICE, args))
-    if not settings.ON_PRODUCTION_SERVER:
-        url = '%s?domain=%s' % (url, settings.AWS_PREFIX[7:-1])
-    if settings.AWS_DNS_ROTATOR:
-        # Just to ease on crc32, let's trim the file name
-        i = zlib.crc32(url[len(settings.AWS_PREFIX):]) % settings.AWS_DNS_ROTATOR + 1
-        url = url.replace('http://', 'http://m%s.' % i)
-    return url
+    return utils.get_url_rewriter().thumb_url(getattr(file, 'file', file), args, getattr(file, 'file_thumbs', None))
 
 @register.filter
 def render_thumb( file, args ):
@@ -26,3 +15,23 @@ def render_thumb( file, args ):
     url = thumb(file, args)
     return utils.get_render_string_by_extension(url, {'file': url, 'name':file.name}, True)
 
+@register.filter
+def cdn(file):
+    if not file:
+        return ''
+    return utils.get_url_rewriter().cdn_url(getattr(file, 'file', file))
+
+@register.filter
+def cdn_urls(files):
+    """ The CDN urls of a list or queryset of S3Mixin objects, in one pass """
+    return utils.get_url_rewriter().cdn_urls(files)
+
+@register.filter
+def thumb_urls(files, args):
+    """ {% for url in gallery.items|thumb_urls:"100x100" %} """
+    return utils.get_url_rewriter().thumb_urls(files, args)
+
+@register.filter
+def render_many(files, mode='render'):
+    """ {% for html in gallery.items|render_many:"thumb" %}, mode is 'render', 'visible' or 'thumb' """
+    return utils.render_many(files, mode)
@@ -0,0 +1,78 @@
+# Python imports
+import logging
+import threading
+from StringIO import StringIO
+
+# Django imports
+from django.conf import settings
+
+# PIL is optional, without it thumbnails are left to settings.THUMBNAIL_SERVICE
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+FORMATS = {'.jpg': 'JPEG', '.jpe': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF'}
+JPEG_QUALITY = 85
+
+def available():
+    return Image is not None
+
+def resize(job):
+    """
+        Returns the data of an image scaled down to fit size, a (width, height) tuple where 0 leaves a dimension free.
+        Takes a (data, size, format) tuple and is module level, so it can run on a process pool
+    """
+    data, size, format = job
+    image = Image.open(StringIO(data))
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    width, height = size
+    # thumbnail() keeps the aspect ratio and never enlarges
+    image.thumbnail((width or image.size[0], height or image.size[1]), Image.ANTIALIAS)
+    output = StringIO()
+    if format == 'JPEG':
+        image.save(output, format, quality=JPEG_QUALITY, optimize=True)
+    else:
+        image.save(output, format)
+    return output.getvalue()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+        Returns the process wide pool resizing images (settings.AWS_THUMBNAIL_PROCESSES processes,
+        one per CPU by default), or None to resize in the calling thread: when set to 0 or where
+        processes can not be started (e.g. AppEngine)
+    """
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                processes = getattr(settings, 'AWS_THUMBNAIL_PROCESSES', None)
+                if processes == 0:
+                    _pool = False
+                else:
+                    try:
+                        import multiprocessing
+                        _pool = multiprocessing.Pool(processes)
+                    except (ImportError, OSError, NotImplementedError), e:
+                        logging.warning('s3mixin resizes thumbnails inline, no process pool: %s' % e)
+                        _pool = False
+        finally:
+            _pool_lock.release()
+    return _pool or None
+
+def generate(data, sizes, extension):
+    """ Returns the data of the thumbnails of an image at each of sizes ('WxH' strings), resized in parallel on get_pool() """
+    format = FORMATS[extension.lower()]
+    jobs = [(data, tuple([int(dimension) for dimension in size.split('x')]), format) for size in sizes]
+    pool = get_pool()
+    if pool is None:
+        return map(resize, jobs)
+    return pool.map(resize, jobs)
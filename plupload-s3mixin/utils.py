@@ -1,8 +1,14 @@
 # Python imports
 import mimetypes
 import os
+from collections import namedtuple
+import re
+import urllib
+import urlparse
+import zlib
 
 # Django imports
+from django.conf import settings
 from django.forms.util import flatatt
 from django.utils.safestring import mark_safe
 
@@ -21,6 +27,145 @@ RENDER_MIMES = {
                 }
 
 VISIBLE_MIMES = ('image', '*')
+# Default types to be saved on the server side and not on S3
+SERVER_TYPES = ('.html', '.htm', '.css')
+# s3.amazonaws.com, s3-eu-west-1.amazonaws.com, s3.eu-west-1.amazonaws.com... with an optional bucket subdomain
+S3_HOST_RE = re.compile(r'^(?:(?P<bucket>.+)\.)?s3(?:[.-][a-z0-9-]+)*\.amazonaws\.com$')
+
+def parse_s3_url(url):
+    """
+        Returns the (bucket, key) of an S3 object url, or None for urls of anything else.
+        Understands virtual host (http://bucket.s3.amazonaws.com/key),
+        path style (http://s3-eu-west-1.amazonaws.com/bucket/key) and s3://bucket/key urls
+    """
+    if not url:
+        return None
+    if isinstance(url, unicode):
+        url = url.encode('UTF-8')
+    parts = urlparse.urlsplit(url)
+    path = urllib.unquote(parts.path)
+    if parts.scheme == 's3':
+        bucket, key = parts.netloc, path[1:]
+    elif parts.scheme in ('http', 'https'):
+        match = S3_HOST_RE.match((parts.hostname or '').lower())
+        if not match:
+            return None
+        bucket = match.group('bucket')
+        if bucket:
+            key = path[1:]
+        else:
+            bucket, _, key = path[1:].partition('/')
+    else:
+        return None
+    if not bucket or not key:
+        return None
+    return bucket, key
+
+def format_thumb_size(size):
+    """ 'WxH' of a (width, height) tuple or 'WxH' string, 0 leaves a dimension free """
+    if isinstance(size, basestring):
+        return size
+    return '%sx%s' % (size[0] or 0, size[1] or 0)
+
+def pregenerated_thumb(file, size):
+    """ The url (or key) of the thumbnail of file pregenerated at size, stored next to it: <file>.thumbs/<W>x<H><ext> """
+    return '%s.thumbs/%s%s' % (file, format_thumb_size(size), os.path.splitext(file)[1].lower())
+
+class URLRewriter:
+    """
+    Rewrites S3 file urls (under aws_prefix) into CDN and thumbnail service urls.
+    Everything is derived from the settings once, in the constructor; use get_url_rewriter().
+
+    With a rotator of N, urls are spread over the hosts m1. to mN. of the CDN / thumbnail
+    service, picked by the crc32 of the S3 key so a file always gets the same host.
+    Urls outside of aws_prefix are returned unchanged.
+
+    The *_urls methods take a list of urls, of S3Mixin instances, or a queryset (only
+    its 'file' column is fetched), so a template can rewrite a whole gallery in one call.
+    Thumbnails pregenerated at the size asked for (see S3Mixin.THUMBNAIL_SIZES) are
+    served from the CDN rather than through the thumbnail service.
+    """
+    def __init__(self, aws_prefix, cdn=None, thumbnail_service=None, rotator=0, thumb_domain=None):
+        self.aws_prefix = aws_prefix
+        self.rotator = rotator or 0
+        self.cdn_hosts = cdn and self._hosts(cdn)
+        self.thumb_hosts = thumbnail_service and self._hosts(thumbnail_service)
+        self.thumb_suffix = thumb_domain and '?domain=%s' % thumb_domain or ''
+
+    @classmethod
+    def from_settings(cls):
+        domain = None
+        if not getattr(settings, 'ON_PRODUCTION_SERVER', True):
+            # the thumbnail service needs to be told our bucket when not in production
+            domain = settings.AWS_PREFIX[7:-1]
+        return cls(settings.AWS_PREFIX, getattr(settings, 'AWS_CLOUDFRONT', None),
+                   getattr(settings, 'THUMBNAIL_SERVICE', None), getattr(settings, 'AWS_DNS_ROTATOR', 0), domain)
+
+    def _hosts(self, base):
+        if not self.rotator:
+            return [base]
+        return [base.replace('http://', 'http://m%s.' % (i + 1), 1) for i in xrange(self.rotator)]
+
+    def _key(self, file):
+        # None if file is not an S3 url
+        if not file or not file.startswith(self.aws_prefix):
+            return None
+        return file[len(self.aws_prefix):]
+
+    def _host(self, hosts, key):
+        if len(hosts) == 1:
+            return hosts[0]
+        if isinstance(key, unicode):
+            return hosts[zlib.crc32(key.encode('UTF-8')) % len(hosts)]
+        return hosts[zlib.crc32(key) % len(hosts)]
+
+    def cdn_url(self, file):
+        key = self._key(file)
+        if key is None or not self.cdn_hosts:
+            return file
+        return self._host(self.cdn_hosts, key) + key
+
+    def thumb_url(self, file, size, thumbs=None):
+        """
+            size is a (width, height) tuple or a 'WxH' string, 0 leaves a dimension free.
+            thumbs lists the sizes pregenerated for file, as in S3Mixin.file_thumbs
+        """
+        key = self._key(file)
+        if key is None:
+            return file
+        size = format_thumb_size(size)
+        if thumbs and size in thumbs.split(','):
+            return self.cdn_url(pregenerated_thumb(file, size))
+        if not self.thumb_hosts:
+            return file
+        return '%s%s/%s%s' % (self._host(self.thumb_hosts, key), size, key, self.thumb_suffix)
+
+    def files(self, items):
+        if hasattr(items, 'values_list'):
+            return list(items.values_list('file', flat=True))
+        return [getattr(item, 'file', item) for item in items]
+
+    def cdn_urls(self, items):
+        cdn_url = self.cdn_url
+        return [cdn_url(file) for file in self.files(items)]
+
+    def thumb_urls(self, items, size):
+        thumb_url = self.thumb_url
+        if hasattr(items, 'values_list'):
+            rows = items.values_list('file', 'file_thumbs')
+        else:
+            rows = [(getattr(item, 'file', item), getattr(item, 'file_thumbs', None)) for item in items]
+        return [thumb_url(file, size, thumbs) for file, thumbs in rows]
+
+_url_rewriter = None
+
+def get_url_rewriter():
+    """ Returns the URLRewriter of the settings """
+    global _url_rewriter
+    if _url_rewriter is None:
+        _url_rewriter = URLRewriter.from_settings()
+    return _url_rewriter
+
 # Helpers
 def get_render_string_by_extension(file_name, params, only_visibles=False):
     """
@@ -29,13 +174,73 @@ def get_render_string_by_extension(file_name, params, only_visibles=False):
         only_visibles avoids rendering non displayable types like javascript/css while keep displaying swfs/images
         attributes is the HTML attributes of the element
     """
-    if '?' in file_name: file_name = file_name[:file_name.index('?')]
-    mime_type = mimetypes.guess_type(file_name)[0]
-    if not mime_type:
-        mime_type = 'application'
-    return get_render_string(mime_type, params, only_visibles)
+    info = get_mime_info(file_name)
+    return format_render_string(info.visible_render if only_visibles else info.render, params)
 
 def get_render_string(mime_type, params, only_visibles=False):
+    return format_render_string(get_render_parts(mime_type, only_visibles), params)
+
+def format_render_string(parts, params):
+    template, attrs, uses_file_base = parts
+    params['attrs'] = attrs
+    if 'thumb' not in params: params['thumb'] = ''
+    if uses_file_base and 'file_base' not in params: params['file_base'] = os.path.splitext(os.path.basename(params['file']))[0]
+    return mark_safe(template % params)
+
+RENDER_MODES = ('render', 'visible', 'thumb')
+
+def render_many(items, mode='render'):
+    """
+        Renders S3Mixin instances as their render(), render_visible() or render_thumb() would
+        (mode 'render', 'visible' or 'thumb'), returning a list of HTML strings.
+        A whole gallery is rendered in one pass, without the per item render cache lookups
+    """
+    if mode not in RENDER_MODES:
+        raise ValueError('Unknown render mode %r' % mode)
+    rewriter = get_url_rewriter()
+    cdn_url = rewriter.cdn_url
+    only_visibles = mode != 'render'
+    params = {'thumb': ''}
+    results = []
+    append = results.append
+    for item in items:
+        file = item.file
+        if not file:
+            if mode == 'thumb':
+                append('No Thumbnail')
+            elif mode == 'visible' and item.file_data:
+                append(mark_safe(item.file_data))
+            else:
+                append('')
+            continue
+        if mode == 'thumb':
+            w, h = item.size()
+            url = rewriter.thumb_url(file, (w, h), item.file_thumbs) if (w or h) else cdn_url(file)
+        else:
+            url = cdn_url(file)
+        info = get_mime_info(url)
+        template, attrs, uses_file_base = info.visible_render if only_visibles else info.render
+        params['file'] = url
+        params['name'] = item.name
+        params['attrs'] = attrs
+        if uses_file_base:
+            params['file_base'] = os.path.splitext(os.path.basename(url))[0]
+        append(mark_safe(template % params))
+    return results
+
+# (mime type, only_visibles) -> render_string_parts()
+RENDER_DISPATCH = {}
+
+def get_render_parts(mime_type, only_visibles=False):
+    """ render_string_parts(), computed once per mime type """
+    key = (mime_type, only_visibles)
+    parts = RENDER_DISPATCH.get(key)
+    if parts is None:
+        parts = RENDER_DISPATCH[key] = render_string_parts(mime_type, only_visibles)
+    return parts
+
+def render_string_parts(mime_type, only_visibles=False):
+    """ Returns the RENDER_MIMES template of mime_type, its HTML attributes and whether it uses file_base """
     attrs = {}
     if mime_type in RENDER_MIMES:
         render_mime_type = mime_type if not only_visibles or mime_type in VISIBLE_MIMES else '*'
@@ -59,7 +264,40 @@ def get_render_string(mime_type, params, only_visibles=False):
                 attrs['class'] += ' ' + c
         else:
             attrs['class'] = c
-    params['attrs'] = flatatt(attrs)
-    if 'thumb' not in params: params['thumb'] = ''
-    if 'file_base' not in params: params['file_base'] = os.path.splitext(os.path.basename(params['file']))[0]
-    return mark_safe(RENDER_MIMES[render_mime_type] % params)
+    template = RENDER_MIMES[render_mime_type]
+    return template, flatatt(attrs), '%(file_base)s' in template
+
+# What there is to know about files of an extension. render and visible_render are the
+# (template, attrs, uses_file_base) render_string_parts() returns for them, visible tells if they are
+# rendered as is by render_visible and server_side if they belong to SERVER_TYPES
+MimeInfo = namedtuple('MimeInfo', 'mime_type major render visible_render visible server_side')
+
+def mime_info(extension, mime_type):
+    render_as = mime_type or 'application'
+    render = get_render_parts(render_as, False)
+    visible_render = get_render_parts(render_as, True)
+    return MimeInfo(mime_type, render_as.partition('/')[0], render, visible_render,
+                    visible_render[0] == render[0], extension in SERVER_TYPES)
+
+def build_mime_index():
+    """ Maps every extension known to mimetypes (lower cased) to its MimeInfo """
+    mimetypes.init()
+    index = {}
+    for extension, mime_type in sorted(mimetypes.types_map.items()):
+        # an exact lower case entry wins over the lower cased one, as in mimetypes.guess_type
+        if extension == extension.lower() or extension.lower() not in index:
+            index[extension.lower()] = mime_info(extension.lower(), mime_type)
+    for extension in SERVER_TYPES:
+        if extension not in index:
+            index[extension] = mime_info(extension, None)
+    return index
+
+MIME_INDEX = build_mime_index()
+UNKNOWN_MIME = mime_info('', None)
+
+def get_mime_info(file_name):
+    """ Returns the MimeInfo of a file name or url, one dict lookup """
+    if not file_name:
+        return UNKNOWN_MIME
+    if '?' in file_name: file_name = file_name[:file_name.index('?')]
+    return MIME_INDEX.get(os.path.splitext(file_name)[1].lower(), UNKNOWN_MIME)
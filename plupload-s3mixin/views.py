@@ -1,27 +1,64 @@
 import base64
 import time
 import logging
-import mimetypes
 import os
+import threading
+from django.http import HttpResponseNotAllowed
 from django.utils import simplejson
 from djangotoolbox.http import JSONResponse
-from s3mixin.models import SUPPORTED_FORMATS
+import S3
+from s3mixin.models import SUPPORTED_FORMATS, get_aws_connection
+from s3mixin.utils import get_mime_info
 from django.conf import settings
-import hmac, sha
 
-def s3policy(request, prefix):
+ACL = 'public-read'
+CACHE_CONTROL = 'public, max-age=2629743'
+# seconds a signed policy stays valid
+POLICY_EXPIRES_IN = 30000
+SUPPORTED_EXTENSIONS = frozenset(['.' + extension for extension in SUPPORTED_FORMATS.split(',')])
+# seconds a signed part url stays valid
+PART_URL_EXPIRES_IN = 60 * 60
+# s3multipart actions changing the state of an upload, only served over POST
+MULTIPART_POST_ACTIONS = ('initiate', 'complete', 'abort')
+
+_policy_template = None
+
+def get_policy_template():
+    """
+        The policy document with %(expiration)s, %(key)s, %(filename)s and %(content_type)s
+        slots for JSON strings, serialized once so signing a file only fills them in
+    """
+    global _policy_template
+    if _policy_template is None:
+        slot = lambda name: '\0%s\0' % name
+        template = simplejson.dumps({"expiration": slot('expiration'),
+                  "conditions": [
+                    {"bucket": settings.AWS_BUCKET},
+                    {"acl": ACL},
+                    {"key": slot('key')},
+                    {"Cache-Control": CACHE_CONTROL},
+                    {"Filename": slot('filename')},
+                    {"name": slot('filename')},
+                    {"Content-Type": slot('content_type')},
+                    ["eq", "$success_action_status", "201"],
+                  ]
+                }).replace('%', '%%')
+        for name in ('expiration', 'key', 'filename', 'content_type'):
+            template = template.replace(simplejson.dumps(slot(name)), '%%(%s)s' % name)
+        _policy_template = template
+    return _policy_template
+
+def check_upload(filename, file_size):
+    """ Returns the content type of filename and an error message, empty if it may be uploaded """
     error_msg = ''
-    acl = 'public-read'
     # TODO: Amazon time difference is strange - investigate
-    filename = request.GET['filename']
     extension = os.path.splitext(os.path.basename(filename))[1].lower()
-    if extension[1:] not in SUPPORTED_FORMATS.split(','):
+    if extension not in SUPPORTED_EXTENSIONS:
         error_msg = 'Filetype %s (%s) is not allowed' % (extension, filename)
-    content_type = mimetypes.guess_type(filename)[0]
+    content_type = get_mime_info(filename).mime_type
     if not content_type:
         content_type = 'application/octet-stream'
     big_content_type = content_type.partition('/')[0]
-    file_size = int(request.GET.get('file_size', 10))
 #        if big_content_type=='image' and file_size>1048576:
 #            error_msg = '%s is too large. Max size image 1MB.' % (filename)
 #    if file_size>10485760:
@@ -31,36 +68,38 @@ def s3policy(request, prefix):
         error_msg = 'File size is zero'
     if file_size > settings.AWS_MAX_FILE_SIZE:
         error_msg = 'Selected file is too large (max is %dMB)' % (settings.AWS_MAX_FILE_SIZE / 1024 / 1024)
+    return content_type, error_msg
 
+def sign_upload(prefix, filename, file_size, expiration=None):
+    """
+        Returns the POST parameters uploading filename to S3 under prefix,
+        or {'errorMessage': ...} if the file may not be uploaded
+    """
+    content_type, error_msg = check_upload(filename, file_size)
     if error_msg:
         logging.info('s3policy error %s' % error_msg)
-        return JSONResponse({'errorMessage':error_msg})
+        return {'errorMessage':error_msg}
 
     #expires = rfc822.formatdate(time.mktime((datetime.datetime.now() + datetime.timedelta(days=360)).timetuple())),
     key = '%s/%s/%s' % (prefix, time.time(), filename)
-    expiration_date = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time()+30000))
-    policy_document = simplejson.dumps({"expiration": expiration_date,
-                  "conditions": [
-                    {"bucket": settings.AWS_BUCKET},
-                    {"acl": acl},
-                    {"key": key},
-                    {"Cache-Control": "public, max-age=2629743"},
-                    {"Filename": filename},
-                    {"name": filename},
-                    {"Content-Type": content_type},
-                    ["eq", "$success_action_status", "201"],
-                  ]
-                })
+    if expiration is None:
+        expiration = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time()+POLICY_EXPIRES_IN))
+    policy_document = get_policy_template() % {
+        'expiration': simplejson.dumps(expiration),
+        'key': simplejson.dumps(key),
+        'filename': simplejson.dumps(filename),
+        'content_type': simplejson.dumps(content_type),
+    }
     policy = base64.b64encode(policy_document.encode('utf-8'))
-    signature = base64.b64encode(hmac.new(settings.AWS_SECRET_ACCESS_KEY, policy, sha).digest())
+    signature = get_aws_connection().signer.sign(policy)
 
     response = {
         'policy': policy,
         'signature': signature,
         'AWSAccessKeyId': settings.AWS_ACCESS_KEY_ID,
-        'Cache-Control': 'public, max-age=2629743',
+        'Cache-Control': CACHE_CONTROL,
         'Content-Type': content_type,
-        'acl': acl,
+        'acl': ACL,
         'key': key,
         'success_action_status': '201'
     }
@@ -68,7 +107,149 @@ def s3policy(request, prefix):
     # Needed when resizing since Flash advancedUpload does not send this and S3 policy fails
     if filename.lower().endswith('jpg') or filename.lower().endswith('png'):
         response['Filename'] = filename
+    return response
 
+def s3policy(request, prefix):
+    filename = request.GET['filename']
+    response = sign_upload(prefix, filename, int(request.GET.get('file_size', 10)))
     json_response = JSONResponse(response)
-    json_response.filename = key
-    return json_response
\ No newline at end of file
+    json_response.filename = response.get('key')
+    return json_response
+
+def s3policy_batch(request, prefix):
+    """
+        Signs a whole selection in one request: 'filename' and 'file_size' are repeated
+        once per file (GET or POST). Returns {'files': [...]} holding what s3policy
+        would return for each file, in the same order.
+        The response's filenames lists the S3 keys, None for files which were refused.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    filenames = params.getlist('filename')
+    file_sizes = params.getlist('file_size')
+    # one expiration for the batch, the documents differ by their key, filename and content type
+    expiration = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time()+POLICY_EXPIRES_IN))
+    files = []
+    for i, filename in enumerate(filenames):
+        file_size = int(file_sizes[i]) if i < len(file_sizes) and file_sizes[i] else 10
+        files.append(sign_upload(prefix, filename, file_size, expiration))
+    json_response = JSONResponse({'files': files})
+    json_response.filenames = [response.get('key') for response in files]
+    return json_response
+
+_part_url_generator = None
+_part_url_generator_lock = threading.Lock()
+
+def get_part_url_generator():
+    """ A QueryStringAuthGenerator addressing S3 like the shared connection, for signing part urls """
+    global _part_url_generator
+    if _part_url_generator is None:
+        _part_url_generator_lock.acquire()
+        try:
+            if _part_url_generator is None:
+                connection = get_aws_connection()
+                generator = S3.QueryStringAuthGenerator(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
+                    connection.is_secure, connection.server, connection.port, connection.calling_format, connection.signer)
+                generator.set_expires_in(PART_URL_EXPIRES_IN)
+                _part_url_generator = generator
+        finally:
+            _part_url_generator_lock.release()
+    return _part_url_generator
+
+def multipart_part_size(file_size):
+    part_size = getattr(settings, 'AWS_MULTIPART_PART_SIZE', S3.DEFAULT_PART_SIZE)
+    return max(part_size, S3.MIN_PART_SIZE, (file_size + S3.MAX_PARTS - 1) / S3.MAX_PARTS)
+
+def multipart_max_parts():
+    """
+        The most parts an upload of at most AWS_MAX_FILE_SIZE can have. The file size sent to initiate
+        is the browser's word, so part urls are signed up to this rather than to that size's part count
+    """
+    part_size = multipart_part_size(0)
+    return min(S3.MAX_PARTS, (settings.AWS_MAX_FILE_SIZE + part_size - 1) / part_size)
+
+def s3multipart(request, prefix):
+    """
+        Browser-direct multipart uploads of large files. The 'action' parameter picks:
+            initiate (filename, file_size): starts an upload, returns key, uploadId and partSize
+            sign (key, uploadId, partNumber - repeatable): returns urls, {partNumber: presigned PUT url}
+            list (key, uploadId): returns parts, [{partNumber, size}] of the parts on S3, to resume
+            complete (key, uploadId, parts - the number of parts): assembles the parts listed on S3
+            abort (key, uploadId)
+        initiate, complete and abort must be POSTed. Errors are returned as {'errorMessage': ...}.
+        Keys outside of prefix are refused, and so is completing an upload whose parts add up to
+        more than AWS_MAX_FILE_SIZE, which is then aborted.
+        Like s3policy's, the response of initiate has the new key as its filename.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    action = params.get('action')
+    if action in MULTIPART_POST_ACTIONS and request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    bucket = settings.AWS_BUCKET
+    connection = get_aws_connection()
+    if action == 'initiate':
+        filename = params['filename']
+        file_size = int(params.get('file_size', 0))
+        content_type, error_msg = check_upload(filename, file_size)
+        if error_msg:
+            logging.info('s3multipart error %s' % error_msg)
+            return JSONResponse({'errorMessage': error_msg})
+        key = '%s/%s/%s' % (prefix, time.time(), filename)
+        headers = {'x-amz-acl': ACL, 'Content-Type': content_type, 'Cache-Control': CACHE_CONTROL}
+        response = connection.initiate_multipart_upload(bucket, key.encode('utf-8'), headers)
+        if response.http_response.status >= 300:
+            logging.error('s3multipart could not initiate %s: %s' % (key, response.message))
+            return JSONResponse({'errorMessage': 'Could not start the upload'})
+        json_response = JSONResponse({'key': key, 'uploadId': response.upload_id, 'partSize': multipart_part_size(file_size)})
+        json_response.filename = key
+        return json_response
+
+    key = params.get('key', '')
+    upload_id = params.get('uploadId')
+    if not key.startswith(prefix + '/') or not upload_id:
+        return JSONResponse({'errorMessage': 'Invalid upload'})
+    s3_key = key.encode('utf-8')
+
+    if action == 'sign':
+        generator = get_part_url_generator()
+        urls = {}
+        max_parts = multipart_max_parts()
+        for part_number in params.getlist('partNumber'):
+            part_number = int(part_number)
+            if not 1 <= part_number <= max_parts:
+                return JSONResponse({'errorMessage': 'Invalid part number %s' % part_number})
+            urls[part_number] = generator.generate_url('PUT', bucket, s3_key, {'partNumber': part_number, 'uploadId': upload_id})
+        return JSONResponse({'urls': urls})
+
+    if action in ('list', 'complete'):
+        # the parts are listed from S3 rather than trusted from the browser, which needs no access to the ETags
+        try:
+            parts = connection.list_all_parts(bucket, s3_key, upload_id)
+        except IOError, e:
+            logging.info('s3multipart %s' % e)
+            return JSONResponse({'errorMessage': 'Unknown upload'})
+
+    if action == 'list':
+        return JSONResponse({'parts': [{'partNumber': part.part_number, 'size': part.size} for part in parts.values()]})
+
+    if action == 'complete':
+        expected = int(params.get('parts', 0))
+        if not expected or sorted(parts.keys()) != range(1, expected + 1):
+            return JSONResponse({'errorMessage': 'The upload is missing parts'})
+        # the size sent to initiate was not checked against the parts actually uploaded
+        file_size = sum([part.size for part in parts.values()])
+        if file_size > settings.AWS_MAX_FILE_SIZE:
+            logging.info('s3multipart %s is %d bytes, aborted' % (key, file_size))
+            connection.abort_multipart_upload(bucket, s3_key, upload_id)
+            return JSONResponse({'errorMessage': 'Selected file is too large (max is %dMB)' % (settings.AWS_MAX_FILE_SIZE / 1024 / 1024)})
+        response = connection.complete_multipart_upload(bucket, s3_key, upload_id,
+                                                        [(number, parts[number].etag) for number in sorted(parts)])
+        if response.http_response.status >= 300 or response.error_code:
+            logging.error('s3multipart could not complete %s: %s' % (key, response.message))
+            return JSONResponse({'errorMessage': 'Could not complete the upload'})
+        return JSONResponse({'key': key})
+
+    if action == 'abort':
+        connection.abort_multipart_upload(bucket, s3_key, upload_id)
+        return JSONResponse({})
+
+    return JSONResponse({'errorMessage': 'Unknown action %s' % action})
@@ -13,11 +13,22 @@ class S3FileWidget(forms.HiddenInput):
     class Meta:
         abstract = True
 
-    def __init__(self, auto_upload=False, required=True, allowed_types=SUPPORTED_FORMATS, multi_selection=True, signature_url='../s3policy', *args, **kwargs):
+    def __init__(self, auto_upload=False, required=True, allowed_types=SUPPORTED_FORMATS, multi_selection=True, signature_url='../s3policy',
+                 batch_signature_url='../s3policy_batch', multipart_url=None, parallel_parts=4, part_retries=5, *args, **kwargs):
+        """
+            batch_signature_url (a view calling s3mixin.views.s3policy_batch) signs all the selected files in one request.
+            When it fails the files are signed one by one through signature_url, None skips it
+            multipart_url (a view calling s3mixin.views.s3multipart) switches to chunked mode: files go to S3 as multipart
+            uploads of parallel_parts parts at once, which resume after a failure. It needs a browser with the HTML5 File API.
+        """
         self.auto_upload = auto_upload
         self.required = required
         self.allowed_types = allowed_types
         self.signature_url = signature_url
+        self.batch_signature_url = batch_signature_url
+        self.multipart_url = multipart_url
+        self.parallel_parts = parallel_parts
+        self.part_retries = part_retries
         self.multi_selection = multi_selection
         super(forms.HiddenInput, self).__init__(*args, **kwargs)
 
@@ -34,12 +45,21 @@ class S3FileWidget(forms.HiddenInput):
                 </div>''' % (attrs['id'],
                             link,
                             ))
+        if self.multipart_url:
+            return output + mark_safe(u'''
+            <input type="file" id="%(id)s-upload" accept="%(accept)s"%(multiple)s></p>
+            <p id="%(id)s-filelist"></p>''' %
+            {'id': self.attrs['id'],
+             'accept': ','.join(['.' + extension for extension in self.allowed_types.split(',')]),
+             'multiple': ' multiple' if self.multi_selection else ''})
         return output + mark_safe(u'''
             <span id="%(id)s-upload" class="button-gd">Select File</span></p>
             <p id="%(id)s-filelist"></p>''' %
             {'id': self.attrs['id']})
 
     def javascript(self):
+        if self.multipart_url:
+            return self.multipart_javascript()
         return mark_safe(u'''
                 var uploader =  new plupload.Uploader({
                     runtimes : 'flash',
@@ -49,6 +69,7 @@ class S3FileWidget(forms.HiddenInput):
                     multi_selection: %(multi_selection)s,
                     form: $('#%(id)s').closest('form'),
                     signature_url: '%(signature_url)s',
+                    batch_signature_url: '%(batch_signature_url)s',
                     auto_upload: '%(auto_upload)s',
                     browse_button : '%(id)s-upload',
                     filelistelement: $('#%(id)s-filelist'),
@@ -71,6 +92,7 @@ class S3FileWidget(forms.HiddenInput):
                 % {
                     'multi_selection': 'true' if self.multi_selection else 'false',
                     'signature_url': self.signature_url,
+                    'batch_signature_url': self.batch_signature_url or '',
                    # swf: '%ss3_upload.swf',
                     'swf_url': media_url('plupload/plupload.flash.swf'),
                    # $('#%s').val('');
@@ -83,4 +105,30 @@ class S3FileWidget(forms.HiddenInput):
                     'name': self.name,
                     'allowed_types': self.allowed_types,
                     'max_file_size': settings.AWS_MAX_FILE_SIZE,
+                   } )
+
+    def multipart_javascript(self):
+        return mark_safe(u'''
+                bindS3MultipartInput({
+                    input: $('#%(id)s-upload'),
+                    multipart_url: '%(multipart_url)s',
+                    aws_prefix: '%(aws_prefix)s',
+                    parallel_parts: %(parallel_parts)d,
+                    part_retries: %(part_retries)d,
+                    form: $('#%(id)s').closest('form'),
+                    auto_upload: %(auto_upload)s,
+                    filelistelement: $('#%(id)s-filelist'),
+                    max_file_size : %(max_file_size)d,
+                    file_input_name: '%(name)s'
+                });
+                '''
+                % {
+                    'id': self.attrs['id'],
+                    'multipart_url': self.multipart_url,
+                    'aws_prefix': settings.AWS_PREFIX,
+                    'parallel_parts': self.parallel_parts,
+                    'part_retries': self.part_retries,
+                    'auto_upload': 'true' if self.auto_upload else 'false',
+                    'max_file_size': settings.AWS_MAX_FILE_SIZE,
+                    'name': self.name,
                    } )
\ No newline at end of file
@@ -0,0 +1,53 @@
+# Tests of the storage format of S3Mixin.file_data, which needs no Django.
+# Run with: python -m unittest discover -s tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plupload-s3mixin'))
+import filedata
+
+class FileDataTest(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        stored = filedata.encode(value)
+        decoded = filedata.decode(stored)
+        self.assertEqual(decoded, value)
+        self.assertTrue(isinstance(decoded, unicode))
+        return stored
+
+    def test_short_values_are_stored_plain(self):
+        stored = self.assertRoundTrip(u'caf\xe9 { color: red; }')
+        self.assertFalse(filedata.is_encoded(stored))
+        self.assertEqual(stored, 'caf\xc3\xa9 { color: red; }')
+
+    def test_long_values_are_compressed(self):
+        value = u'.caf\xe9 { background: url(\u2603.png); }\n' * 100
+        stored = self.assertRoundTrip(value)
+        self.assertTrue(filedata.is_encoded(stored))
+        self.assertTrue(len(stored) < len(value))
+
+    def test_utf8_str_values(self):
+        value = '<p>d\xc3\xa9j\xc3\xa0 vu</p>\n' * 100
+        self.assertEqual(filedata.decode(filedata.encode(value)), value.decode('utf-8'))
+        self.assertEqual(filedata.decode(filedata.encode(value[:20])), value[:20].decode('utf-8'))
+
+    def test_values_starting_with_the_marker(self):
+        self.assertTrue(filedata.is_encoded(self.assertRoundTrip(filedata.MARKER + u'short')))
+
+    def test_incompressible_values_are_stored_plain(self):
+        value = u''.join([unichr(0x4e00 + (i * 7919) % 20000) for i in xrange(300)])
+        stored = self.assertRoundTrip(value)
+        self.assertEqual(filedata.is_encoded(stored), len(stored) < len(value.encode('utf-8')))
+
+    def test_invalid_utf8_is_refused_whatever_its_length(self):
+        self.assertRaises(UnicodeDecodeError, filedata.encode, 'caf\xe9')
+        self.assertRaises(UnicodeDecodeError, filedata.encode, 'caf\xe9 ' * 1000)
+
+    def test_plain_rows_read_unchanged(self):
+        self.assertEqual(filedata.decode(u'body {}'), u'body {}')
+        self.assertEqual(filedata.decode(None), None)
+        self.assertEqual(filedata.encode(None), None)
+        self.assertEqual(filedata.decode(u''), u'')
+
+if __name__ == '__main__':
+    unittest.main()
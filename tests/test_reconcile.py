@@ -0,0 +1,57 @@
+# Tests of the pure parts of s3mixin.reconcile. They need the app installed as s3mixin
+# (with Django), and are skipped otherwise.
+# Run with: python -m unittest discover -s tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    from s3mixin import reconcile
+except ImportError:
+    reconcile = None
+
+class Entry:
+    def __init__(self, key):
+        self.key = key
+
+def diff(keys, rows):
+    return [(key, entry is not None and entry.key or None, matched)
+            for key, entry, matched in reconcile.merge_diff([Entry(key) for key in keys], rows)]
+
+class MergeDiffTest(unittest.TestCase):
+    def setUp(self):
+        if reconcile is None:
+            self.skipTest('needs s3mixin and Django')
+
+    def test_orphans_and_missing(self):
+        rows = [('b.jpg', 'app.Item', 1), ('d.jpg', 'app.Item', 2)]
+        self.assertEqual(diff([u'a.jpg', u'b.jpg', u'c.jpg'], rows), [
+            ('a.jpg', u'a.jpg', []),
+            ('b.jpg', u'b.jpg', [('b.jpg', 'app.Item', 1)]),
+            ('c.jpg', u'c.jpg', []),
+            ('d.jpg', None, [('d.jpg', 'app.Item', 2)]),
+        ])
+
+    def test_rows_sharing_a_key(self):
+        rows = [('cas/1.jpg', 'app.Item', 1), ('cas/1.jpg', 'app.Other', 7)]
+        self.assertEqual(diff([u'cas/1.jpg'], rows), [
+            ('cas/1.jpg', u'cas/1.jpg', rows),
+        ])
+
+    def test_keys_compare_as_utf8(self):
+        # the listing is in UTF-8 byte order, the rows' keys are UTF-8 encoded
+        rows = [('caf\xc3\xa9.jpg', 'app.Item', 1), ('caf\xef\xac\x81.jpg', 'app.Item', 2)]
+        self.assertEqual(diff([u'caf\xe9.jpg', u'caf\ufb01.jpg', u'cag.jpg'], rows), [
+            ('caf\xc3\xa9.jpg', u'caf\xe9.jpg', rows[:1]),
+            ('caf\xef\xac\x81.jpg', u'caf\ufb01.jpg', rows[1:]),
+            ('cag.jpg', u'cag.jpg', []),
+        ])
+
+    def test_empty_sides(self):
+        self.assertEqual(diff([], []), [])
+        self.assertEqual(diff([u'a.jpg'], []), [('a.jpg', u'a.jpg', [])])
+        self.assertEqual(diff([], [('a.jpg', 'app.Item', 1)]), [('a.jpg', None, [('a.jpg', 'app.Item', 1)])])
+
+if __name__ == '__main__':
+    unittest.main()
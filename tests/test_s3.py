@@ -0,0 +1,189 @@
+# Tests of the S3 library which need no network: requests are answered by FakeConnection.
+# Run with: python -m unittest discover -s tests
+import os
+import re
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import S3
+
+MB = 1024 * 1024
+
+def rss():
+    """ Resident memory of this process in bytes, None where /proc is not available """
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+class FakeHTTPResponse:
+    def __init__(self, status, body='', headers=None):
+        self.status = status
+        self.reason = ''
+        self.msg = headers or {}
+        self._body = body
+
+    def read(self, amt=None):
+        body, self._body = self._body, ''
+        return body
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name.lower(), default)
+
+    def close(self):
+        pass
+
+class MultipartConnection(S3.AWSAuthConnection):
+    """ Answers the requests of a multipart upload in memory, recording the peak RSS while parts are sent """
+    def __init__(self):
+        S3.AWSAuthConnection.__init__(self, 'id', 'secret')
+        self.parts = {}
+        self.peak_rss = 0
+
+    def initiate_multipart_upload(self, bucket, key, headers={}, metadata={}):
+        return S3.InitiateMultipartUploadResponse(FakeHTTPResponse(200,
+            '<InitiateMultipartUploadResult><UploadId>u1</UploadId></InitiateMultipartUploadResult>'))
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        self.peak_rss = max(self.peak_rss, rss())
+        self.parts[part_number] = len(data)
+        return S3.Response(FakeHTTPResponse(200, headers={'etag': '"etag%d"' % part_number}))
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts, headers={}):
+        self.completed = parts
+        return S3.CompleteMultipartUploadResponse(FakeHTTPResponse(200,
+            '<CompleteMultipartUploadResult><ETag>"e"</ETag></CompleteMultipartUploadResult>'))
+
+class FailingConnection(S3.AWSAuthConnection):
+    """ Answers every request with status after delay seconds, counting the requests sent """
+    def __init__(self, retry_policy, status=503, delay=0):
+        S3.AWSAuthConnection.__init__(self, 'id', 'secret', retry_policy=retry_policy)
+        self.status = status
+        self.delay = delay
+        self.sent = 0
+
+    def _send_request(self, is_secure, host, method, path, body, headers, timeout=None):
+        self.sent += 1
+        time.sleep(self.delay)
+        return FakeHTTPResponse(self.status)
+
+class ListingConnection(S3.AWSAuthConnection):
+    """ Serves a bucket listing of pages (lists of unicode keys), picking the page after the marker sent """
+    def __init__(self, pages):
+        S3.AWSAuthConnection.__init__(self, 'id', 'secret')
+        self.pages = pages
+        self.markers = []
+
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        # builds the query string like a real request would
+        query_string = S3.query_args_hash_to_string(query_args)
+        marker = query_args.get('marker', '')
+        self.markers.append(marker)
+        index = 0
+        if marker:
+            index = [page[-1].encode('utf-8') for page in self.pages].index(marker) + 1
+        body = [u'<ListBucketResult><IsTruncated>%s</IsTruncated>' % (index < len(self.pages) - 1 and 'true' or 'false')]
+        for name in self.pages[index]:
+            body.append(u'<Contents><Key>%s</Key><LastModified>2010-01-01T00:00:00.000Z</LastModified>'
+                        u'<ETag>"e"</ETag><Size>1</Size></Contents>' % name)
+        body.append(u'</ListBucketResult>')
+        return FakeHTTPResponse(200, u''.join(body).encode('utf-8'))
+
+class DeleteConnection(S3.AWSAuthConnection):
+    """ Answers Multi-Object Deletes, failing the keys in failing, and records the bodies sent """
+    def __init__(self, failing=()):
+        S3.AWSAuthConnection.__init__(self, 'id', 'secret')
+        self.failing = failing
+        self.bodies = []
+
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        self.bodies.append(data)
+        keys = re.findall('<Key>(.*?)</Key>', data.decode('utf-8'))
+        body = [u'<DeleteResult>']
+        for name in keys:
+            if name in self.failing:
+                body.append(u'<Error><Key>%s</Key><Code>AccessDenied</Code><Message>Access Denied</Message></Error>' % name)
+            elif '<Quiet>' not in data:
+                body.append(u'<Deleted><Key>%s</Key></Deleted>' % name)
+        body.append(u'</DeleteResult>')
+        return FakeHTTPResponse(200, u''.join(body).encode('utf-8'))
+
+class DeleteManyTest(unittest.TestCase):
+    def test_body_holds_utf8_keys(self):
+        connection = DeleteConnection()
+        connection.delete_many('bucket', ['f\xc3\xa9.jpg', u'caf\xe9 & <b>.png'])
+        self.assertEqual(connection.bodies, ['<?xml version="1.0" encoding="UTF-8"?><Delete><Quiet>true</Quiet>'
+            '<Object><Key>f\xc3\xa9.jpg</Key></Object><Object><Key>caf\xc3\xa9 &amp; &lt;b&gt;.png</Key></Object></Delete>'])
+
+    def test_results_are_the_keys_given(self):
+        keys = ['a.jpg', 'f\xc3\xa9.jpg', u'z\xe9.png']
+        for quiet in (True, False):
+            connection = DeleteConnection(failing=[u'f\xe9.jpg'])
+            result = connection.delete_many('bucket', keys, quiet)
+            self.assertEqual(result.deleted, ['a.jpg', u'z\xe9.png'])
+            self.assertEqual([(error.key, error.code, error.message) for error in result.errors],
+                             [('f\xc3\xa9.jpg', u'AccessDenied', u'Access Denied')])
+
+    def test_batches(self):
+        connection = DeleteConnection()
+        result = connection.delete_many('bucket', ('k%d' % i for i in xrange(S3.MAX_DELETE_KEYS + 1)))
+        self.assertEqual(len(connection.bodies), 2)
+        self.assertEqual(len(result.deleted), S3.MAX_DELETE_KEYS + 1)
+
+class IterBucketTest(unittest.TestCase):
+    def test_non_ascii_key_at_page_boundary(self):
+        connection = ListingConnection([[u'a.jpg', u'caf\xe9.jpg'], [u'd\xe9j\xe0.png', u'z.gif']])
+        keys = [entry.key for entry in connection.iter_bucket('bucket')]
+        self.assertEqual(keys, [u'a.jpg', u'caf\xe9.jpg', u'd\xe9j\xe0.png', u'z.gif'])
+        self.assertEqual(connection.markers, ['', u'caf\xe9.jpg'.encode('utf-8')])
+
+    def test_unicode_marker(self):
+        connection = ListingConnection([[u'caf\xe9.jpg'], [u'z.gif']])
+        keys = [entry.key for entry in connection.iter_bucket('bucket', marker=u'caf\xe9.jpg')]
+        self.assertEqual(keys, [u'z.gif'])
+
+class WorkerJobTest(unittest.TestCase):
+    def test_run_drops_arguments(self):
+        job = S3.WorkerJob(len, ('x' * 10,))
+        job.run()
+        self.assertEqual(job.wait(), 10)
+        self.assertEqual(job.args, None)
+
+class RetryBudgetTest(unittest.TestCase):
+    def test_part_retries_are_paid_from_the_budget(self):
+        policy = S3.RetryPolicy(max_attempts=4, base_delay=0, budget_max=2)
+        connection = FailingConnection(policy)
+        response = connection._call_with_retries(3, connection.upload_part, 'bucket', 'key', 'u1', 1, 'data')
+        self.assertEqual(response.http_response.status, 503)
+        # the first attempt and the 2 retries in the budget, not (1 + 3) * 4 attempts
+        self.assertEqual(connection.sent, 3)
+        self.assertEqual(policy.counters['retries_denied'], 1)
+
+    def test_hedges_are_paid_from_the_budget(self):
+        policy = S3.RetryPolicy(budget_max=0, hedge_after=0.01)
+        connection = FailingConnection(policy, status=200, delay=0.05)
+        connection.get('bucket', 'key')
+        self.assertEqual(connection.sent, 1)
+        self.assertEqual(policy.counters['hedges_denied'], 1)
+
+class PutMultipartTest(unittest.TestCase):
+    def test_memory_is_bounded_by_parts_in_flight(self):
+        if rss() is None:
+            self.skipTest('needs /proc')
+        part_size = S3.MIN_PART_SIZE
+        chunks = 200
+        connection = MultipartConnection()
+        start = rss()
+        response = connection.put_multipart('bucket', 'key', ('x' * MB for i in xrange(chunks)),
+                                            part_size=part_size, workers=2)
+        self.assertEqual(response.http_response.status, 200)
+        self.assertEqual(sum(connection.parts.values()), chunks * MB)
+        self.assertEqual([number for number, etag in sorted(connection.completed)], range(1, len(connection.parts) + 1))
+        # 2 parts sent, 2 queued, one being read and the chunks being joined, not the 200MB of the object
+        self.assertTrue(connection.peak_rss - start < 12 * part_size,
+                        'RSS grew by %dMB' % ((connection.peak_rss - start) / MB))
+
+if __name__ == '__main__':
+    unittest.main()